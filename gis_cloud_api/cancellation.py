@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Cancellation tokens, they are used to stop running network requests
+ and long running exports when user cancels a task.
+
+"""
+
+import threading
+
+from .exception import GISCloudCancelled
+from ..qgis_api.version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import QMetaObject, Qt
+else:
+    from PyQt4.QtCore import QMetaObject, Qt
+
+CURRENT = threading.local()
+
+
+class GISCloudCancellationToken(object):
+    """Token shared by a task and whoever can cancel it"""
+
+    def __init__(self):
+        self.cancelled = False
+        self.replies = set()
+        self.feedbacks = set()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """Cancelling the task and aborting its requests in flight"""
+        with self.lock:
+            self.cancelled = True
+            replies = list(self.replies)
+            feedbacks = list(self.feedbacks)
+        for reply in replies:
+            GISCloudCancellationToken.__abort(reply)
+        for feedback in feedbacks:
+            feedback.cancel()
+
+    def register(self, reply):
+        """Tracking a reply so that cancel can abort it"""
+        with self.lock:
+            if not self.cancelled:
+                self.replies.add(reply)
+                return
+        GISCloudCancellationToken.__abort(reply)
+
+    def unregister(self, reply):
+        """Reply has finished and doesn't need to be tracked"""
+        with self.lock:
+            self.replies.discard(reply)
+
+    def register_feedback(self, feedback):
+        """Tracking QgsFeedback of a QGIS operation, cancel stops it"""
+        with self.lock:
+            if not self.cancelled:
+                self.feedbacks.add(feedback)
+                return
+        feedback.cancel()
+
+    def unregister_feedback(self, feedback):
+        """Operation has finished and its feedback isn't tracked"""
+        with self.lock:
+            self.feedbacks.discard(feedback)
+
+    def check(self):
+        """Raising GISCloudCancelled if task has been cancelled"""
+        if self.cancelled:
+            raise GISCloudCancelled()
+
+    @staticmethod
+    def __abort(reply):
+        # reply lives in the task thread, so abort is queued to its loop
+        QMetaObject.invokeMethod(reply, "abort", Qt.QueuedConnection)
+
+
+def get_current_token():
+    """Token of the current thread, there is always one"""
+    if getattr(CURRENT, "token", None) is None:
+        CURRENT.token = GISCloudCancellationToken()
+    return CURRENT.token
+
+
+def set_current_token(token):
+    """Setting token for the current thread, None resets it"""
+    CURRENT.token = token
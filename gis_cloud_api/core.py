@@ -33,8 +33,10 @@
 
 import json
 import os
+import time
 
-from .exception import handle_error
+from .exception import GISCloudException, handle_error
+from .layer import GISCloudLayer
 from .map import GISCloudMap
 from .network_handler import GISCloudNetworkHandler
 from .user import GISCloudUser
@@ -43,6 +45,12 @@ from ..qgis_api.utils import GISCloudQgisUtils
 
 LOGGER = get_gc_publisher_logger(__name__)
 
+BULK_DELETE_SIZE = 50
+
+# keys of GIS Cloud layers that layer comparison reads
+SNAPSHOT_LAYER_KEYS = ("id", "type", "name", "order", "parent",
+                       "resource_id", "datasource_id")
+
 
 class GISCloudCore(object):
     """Class for handling QGIS Api."""
@@ -57,11 +65,22 @@ class GISCloudCore(object):
         self.datasources_cache = {}
         self.qgis_groups = {}
         self.layers_cache_data = None
+        self.layers_cache_url = None
+        self.layers_cache_etag = None
+        self.layers_cache_time = None
+        self.layers_cache_provisional = False
+        self.remote_snapshot_json = None
         self.files_to_delete_after_upload = []
         self.layers_to_delete = []
         self.giscloud_groups = {}
         self.giscloud_groups_map = {}
         self.current_gc_files = []
+        self.max_concurrent_requests = 6
+        self.bulk_delete_supported = None
+        self.failed_deletions = {}
+        self.manifest = None
+        self.manifest_layers = {}
+        self.manifest_pending = []
         self.map = GISCloudMap(self, qgis_api)
         self.user = GISCloudUser(self, qgis_api)
 
@@ -90,102 +109,424 @@ class GISCloudCore(object):
         self.files_to_delete_after_upload = []
 
     def get_layers(self, use_cache=False):
-        """Get layers that are on GIS Cloud to compare them locally."""
-        self.qgis_api.layers_to_update = {}
-        self.giscloud_groups = {}
-        self.layers_to_delete = []
+        """Get layers that are on GIS Cloud to compare them locally.
+        Raises GISCloudException if the listing couldn't be read
+        completely, nothing is compared in that case."""
+        self.__reset_layers()
+        try:
+            return self.__read_layers(use_cache)
+        except Exception:
+            # comparison of a part of the layers is never kept
+            self.__reset_layers()
+            raise
+
+    def __read_layers(self, use_cache):
         LOGGER.info("gc api get_layers")
+        qgis_layers = GISCloudQgisUtils.get_qgis_layers(self.qgis_api.project)
         if use_cache and self.layers_cache_data:
-            data = self.layers_cache_data
             LOGGER.info("using cache")
+            for layer in self.layers_cache_data:
+                self.__process_layer(layer, qgis_layers)
         else:
-            get_url = "{0}1/maps/{1}/layers.json?expand=options".format(
+            # options of every layer are only needed for maps
+            # published without the manifest
+            previous_manifest = self.manifest
+            self.manifest = self.map.get_manifest()
+            get_url = "{0}1/maps/{1}/layers.json{2}".format(
                 self.host,
-                self.map.map_id)
-            response = GISCloudNetworkHandler.blocking_request(
-                GISCloudNetworkHandler.GET,
+                self.map.map_id,
+                "" if self.manifest else "?expand=options")
+            data = []
+
+            # layers are compared only once the whole listing is read,
+            # cached listing is revalidated with its ETag
+            etag = self.layers_cache_etag \
+                if self.layers_cache_data and \
+                self.layers_cache_url == get_url else None
+            response = GISCloudNetworkHandler.blocking_list_request(
                 get_url,
-                self.user.apikey)
+                self.user.apikey,
+                data.append,
+                etag=etag)
 
-            if response["status_code"] == 200:
-                data = response["response"]["data"]
-            else:
-                if response["status_code"] is not None:
-                    self.map.map_id = None
-                    self.qgis_api.project.writeEntry("giscloud_project",
-                                                     "save_as",
-                                                     self.map.map_id)
+            if response["status_code"] == 304 and etag:
+                LOGGER.info("cached layers are still valid")
+                for layer in self.layers_cache_data:
+                    self.__process_layer(layer, qgis_layers)
+                self.layers_cache_time = time.time()
+                self.layers_cache_provisional = False
+                if self.manifest != previous_manifest:
+                    self.__prepare_remote_snapshot()
+                return True
+            if response["status_code"] is None or \
+                    response["status_code"] == 200 and \
+                    not response["complete"]:
+                raise GISCloudException(
+                    "Layers of the map couldn't be read completely")
+            if response["status_code"] != 200:
+                self.map.map_id = None
+                self.qgis_api.project.writeEntry("giscloud_project",
+                                                 "save_as",
+                                                 self.map.map_id)
                 return False
+            for layer in data:
+                self.__process_layer(layer, qgis_layers)
+            changed = self.manifest != previous_manifest or \
+                data != self.layers_cache_data
             self.layers_cache_data = data
-        self.__process_layers(data)
+            self.layers_cache_url = get_url
+            self.layers_cache_etag = response["etag"]
+            self.layers_cache_time = time.time()
+            self.layers_cache_provisional = False
+            if changed:
+                self.__prepare_remote_snapshot()
         return True
 
-    def __process_layers(self, data):
-        qgis_layers = GISCloudQgisUtils.get_qgis_layers(self.qgis_api.project)
-        for i in data:
-            layer_id = i['id']
-            delete_layer = False
-            if i['type'] == "folder":
-                source = json.loads(i["source"])
-                if source["qgis"] == 1:
-                    self.giscloud_groups[layer_id] = {"id": layer_id,
-                                                      "name": i['name'],
-                                                      "order": int(i['order']),
-                                                      "parent": i['parent']}
-            if 'options' in i and i['options']:
-                for option in i['options']:
-                    if option['option_name'] == 'QGIS_LAYER':
-                        option_value = json.loads(option['option_value'])
-                        if isinstance(option_value, dict):
-                            layer_to_update = \
-                                {"id": layer_id,
-                                 "option_id": option['id'],
-                                 "parent": i['parent'],
-                                 "order": int(i['order']),
-                                 "resource_id": i['resource_id'],
-                                 "datasource_id": i['datasource_id']}
-                            layer_to_update["datasource_timestamp"] = \
-                                option_value["datasource_timestamp"] \
-                                if "datasource_timestamp" in option_value \
-                                else 0
-                            layer_to_update["hash"] = \
-                                option_value["hash"] \
-                                if "hash" in option_value \
-                                else 0
-
-                            delete_layer = True
-                            for layer in qgis_layers:
-                                if layer.id() == option_value["id"]:
-                                    delete_layer = False
-                            if delete_layer:
-                                if (option_value["id"] in
-                                        self.qgis_api.layer_data_timestamps
-                                        .keys()):
-                                    del self.qgis_api.layer_data_timestamps[
-                                        option_value["id"]]
-                                    self.qgis_api.project.writeEntry(
-                                        'giscloud_layers_data_state',
-                                        'state',
-                                        json.dumps(
-                                            self.qgis_api
-                                            .layer_data_timestamps))
-                                self.layers_to_delete.append(layer_id)
-                            else:
-                                self.qgis_api.layers_to_update[
-                                    option_value["id"]] = layer_to_update
+    def __reset_layers(self):
+        self.qgis_api.layers_to_update = {}
+        self.giscloud_groups = {}
+        self.layers_to_delete = []
+
+    def remote_snapshot(self):
+        """Last GIS Cloud layer listing as plain data, it is stored in
+        the project so that the next open can start from it. Only what
+        layer comparison reads is kept."""
+        if not self.layers_cache_data or self.layers_cache_provisional:
+            return None
+        layers = []
+        for layer in self.layers_cache_data:
+            item = dict((key, layer[key]) for key in SNAPSHOT_LAYER_KEYS
+                        if key in layer)
+            if layer.get("type") == "folder":
+                item["source"] = layer.get("source")
+            options = [option for option in layer.get("options") or []
+                       if option.get("option_name") == "QGIS_LAYER"]
+            if options:
+                item["options"] = options
+            layers.append(item)
+        return {"map_id": self.map.map_id,
+                "url": self.layers_cache_url,
+                "etag": self.layers_cache_etag,
+                "time": self.layers_cache_time,
+                "manifest": self.manifest,
+                "layers": layers}
+
+    def __prepare_remote_snapshot(self):
+        """Serializing changed listing on the thread that has read it,
+        main thread only writes the result to the project"""
+        snapshot = self.remote_snapshot()
+        self.remote_snapshot_json = json.dumps(snapshot) \
+            if snapshot else None
+
+    def restore_remote_snapshot(self):
+        """Starting from the layer listing stored in the project, it is
+        used for a provisional analysis until it is revalidated"""
+        if self.layers_cache_data and self.layers_cache_url and \
+                "/maps/{}/".format(self.map.map_id) in self.layers_cache_url:
+            # listing of this map has already been downloaded
+            return False
+        snapshot = self.qgis_api.project.readEntry(
+            "giscloud_project", "remote_snapshot")[0]
+        try:
+            snapshot = json.loads(snapshot) if snapshot else None
+        except ValueError:
+            LOGGER.warning('Invalid stored layer listing', exc_info=True)
+            return False
+        if not snapshot or snapshot.get("map_id") != self.map.map_id:
+            return False
+        self.layers_cache_data = snapshot["layers"]
+        self.layers_cache_url = snapshot["url"]
+        self.layers_cache_etag = snapshot["etag"]
+        self.layers_cache_time = snapshot["time"]
+        self.layers_cache_provisional = True
+        self.remote_snapshot_json = None
+        self.manifest = snapshot["manifest"]
+        return True
+
+    def store_remote_snapshot(self):
+        """Storing changed layer listing in the project, it is called on
+        the main thread and doesn't mark the project as modified"""
+        snapshot = self.remote_snapshot_json
+        if not snapshot:
+            return
+        self.remote_snapshot_json = None
+        project = self.qgis_api.project
+        dirty = project.isDirty()
+        project.writeEntry("giscloud_project",
+                           "remote_snapshot",
+                           snapshot)
+        project.setDirty(dirty)
+
+    def __process_layer(self, i, qgis_layers):
+        # pylint: disable=R0912
+        layer_id = i['id']
+        delete_layer = False
+        if i['type'] == "folder":
+            source = json.loads(i["source"])
+            if source["qgis"] == 1:
+                self.giscloud_groups[layer_id] = {"id": layer_id,
+                                                  "name": i['name'],
+                                                  "order": int(i['order']),
+                                                  "parent": i['parent']}
+        option_id, option_value = self.__get_layer_state(i)
+        if isinstance(option_value, dict):
+            layer_to_update = \
+                {"id": layer_id,
+                 "parent": i['parent'],
+                 "order": int(i['order']),
+                 "resource_id": i['resource_id'],
+                 "datasource_id": i['datasource_id']}
+            layer_to_update["datasource_timestamp"] = \
+                option_value["datasource_timestamp"] \
+                if "datasource_timestamp" in option_value \
+                else 0
+            layer_to_update["hash"] = \
+                option_value["hash"] \
+                if "hash" in option_value \
+                else 0
+            layer_to_update["hashes"] = \
+                option_value.get("hashes")
+            if option_id:
+                layer_to_update["option_id"] = option_id
+
+            delete_layer = True
+            for layer in qgis_layers:
+                if layer.id() == option_value["id"]:
+                    delete_layer = False
+            if delete_layer:
+                if (option_value["id"] in
+                        self.qgis_api.layer_data_timestamps
+                        .keys()):
+                    del self.qgis_api.layer_data_timestamps[
+                        option_value["id"]]
+                    self.qgis_api.project.writeEntry(
+                        'giscloud_layers_data_state',
+                        'state',
+                        json.dumps(
+                            self.qgis_api
+                            .layer_data_timestamps))
+                self.layers_to_delete.append(layer_id)
+            else:
+                self.qgis_api.layers_to_update[
+                    option_value["id"]] = layer_to_update
+
+    def __get_layer_state(self, i):
+        """Sync state of a GIS Cloud layer, from the manifest or from
+        QGIS_LAYER option of the layer for maps published without it"""
+        if self.manifest:
+            return None, self.manifest.get("layers", {}).get(str(i['id']))
+        # option written last is the current one
+        options = [option for option in i.get('options') or []
+                   if option['option_name'] == 'QGIS_LAYER']
+        if not options:
+            return None, None
+        option = max(options, key=lambda option: int(option['id']))
+        return option['id'], json.loads(option['option_value'])
+
+    def start_manifest(self):
+        """Starting sync manifest from state of layers that stay"""
+        self.manifest_pending = []
+        self.manifest_layers = {}
+        if isinstance(self.qgis_api.layers_to_update, dict):
+            for qgis_id, layer in self.qgis_api.layers_to_update.items():
+                self.manifest_layers[str(layer["id"])] = {
+                    "id": qgis_id,
+                    "datasource_timestamp": layer["datasource_timestamp"],
+                    "hash": layer["hash"],
+                    "hashes": layer["hashes"]}
+
+    def use_manifest(self):
+        """Manifest is used unless storing it has failed before"""
+        return self.map.manifest_supported is not False
+
+    def record_layer_state(self, layer_object, layer_id, state):
+        """Keeping layer state, states are saved during and after the sync"""
+        self.manifest_layers[str(layer_id)] = state
+        self.manifest_pending.append(layer_object)
+
+    def save_layer_states(self):
+        """Storing states of all layers and folder mapping at once.
+        If the manifest can't be stored, layers get their QGIS_LAYER
+        options instead and the manifest already on GIS Cloud is removed,
+        so its outdated states aren't read instead of the options."""
+        pending = self.manifest_pending
+        self.manifest_pending = []
+        if self.use_manifest():
+            index = self.qgis_api.layer_tree_index
+            groups = dict((str(folder_id), index.group_id(group))
+                          for group, folder_id in self.qgis_groups.items()
+                          if folder_id != "new" and index.group_id(group))
+            manifest = {"version": 2,
+                        "layers": dict(self.manifest_layers),
+                        "groups": groups}
+            if self.map.save_manifest(manifest):
+                self.manifest = manifest
+                return
+            if self.map.manifest_option_id:
+                self.__save_layer_options(pending,
+                                          self.__other_layer_states(pending))
+                if self.map.delete_manifest():
+                    self.manifest = None
+                return
+        self.__save_layer_options(pending)
+
+    def __other_layer_states(self, layer_objects):
+        """States of layers that weren't synced now, with their resource
+        ids, these were stored only in the manifest"""
+        synced = set(str(layer_object.giscloud_layer.get(
+            "id", layer_object.created_layer_id))
+                     for layer_object in layer_objects)
+        layers = {}
+        if isinstance(self.qgis_api.layers_to_update, dict):
+            layers = dict((str(layer["id"]), layer) for layer
+                          in self.qgis_api.layers_to_update.values())
+        return [(layers[layer_id], state) for layer_id, state
+                in self.manifest_layers.items()
+                if layer_id not in synced and layer_id in layers]
+
+    def __save_layer_options(self, layer_objects, layer_states=()):
+        """Writing QGIS_LAYER options concurrently, resource ids of new
+        layers are fetched with a single listing.
+        layer_states - states of layers that aren't synced now"""
+        missing = dict((str(layer_object.created_layer_id), layer_object)
+                       for layer_object in layer_objects
+                       if not layer_object.resource_id)
+        if missing:
+            def handle_layer(layer):
+                if str(layer['id']) in missing:
+                    missing[str(layer['id'])].resource_id = \
+                        layer['resource_id']
+
+            GISCloudNetworkHandler.blocking_list_request(
+                "{0}1/maps/{1}/layers.json".format(self.host,
+                                                   self.map.map_id),
+                self.user.apikey,
+                handle_layer)
+
+        layer_objects = [layer_object for layer_object in layer_objects
+                         if layer_object.resource_id]
+        names = [layer_object.name for layer_object in layer_objects]
+        requests = [layer_object.option_request()
+                    for layer_object in layer_objects]
+        for layer, state in layer_states:
+            names.append(layer["id"])
+            requests.append(GISCloudLayer.state_option_request(
+                self.host,
+                layer["resource_id"],
+                state,
+                layer.get("option_id")))
+        responses = GISCloudNetworkHandler.blocking_requests(
+            requests,
+            self.user.apikey,
+            self.max_concurrent_requests)
+        for name, response in zip(names, responses):
+            if response["status_code"] not in (201, 204):
+                LOGGER.error('Failed to create option for {}, '
+                             'status code {}'.format(name,
+                                                     response["status_code"]))
+                handle_error(response)
 
     def delete_layers(self):
         """Delete layers on GIS Cloud that have been removed in QGIS"""
-        for layer_id in self.layers_to_delete:
-            layer_url = "{0}/1/layers/{1}.json".format(self.host, layer_id)
-            try:
-                GISCloudNetworkHandler.blocking_request(
+        map_id = str(self.map.map_id)
+        layer_ids = [str(layer_id) for layer_id in self.layers_to_delete]
+        layer_ids += [layer_id for layer_id
+                      in self.failed_deletions.get(map_id, [])
+                      if layer_id not in layer_ids]
+        self.failed_deletions[map_id] = self.delete_resources(layer_ids)
+
+    def store_failed_deletions(self):
+        """Keeping ids that failed to delete in the project, so they
+        are retried after QGIS restarts, called on the main thread"""
+        self.qgis_api.project.writeEntry(
+            'giscloud_failed_deletions',
+            'state',
+            json.dumps(dict((map_id, layer_ids) for map_id, layer_ids
+                            in self.failed_deletions.items()
+                            if layer_ids)))
+
+    def restore_failed_deletions(self):
+        """Reading ids that failed to delete from the project"""
+        failed_deletions = self.qgis_api.project.readEntry(
+            'giscloud_failed_deletions',
+            'state')[0]
+        try:
+            self.failed_deletions = json.loads(failed_deletions) \
+                if failed_deletions else {}
+        except ValueError:
+            LOGGER.warning('Invalid failed deletions', exc_info=True)
+            self.failed_deletions = {}
+
+    def delete_resources(self, resource_ids):
+        """Deleting layers or folders, returns ids that failed to delete
+        so they can be retried on the next sync. We try to delete ids in
+        bulk and fall back to a request per id if server doesn't support
+        it. Already deleted resources (404) are treated as deleted.
+        Bulk delete results are checked per id, ids that it didn't
+        confirm are deleted one by one."""
+        resource_ids = [str(resource_id) for resource_id in resource_ids]
+        single_ids = resource_ids
+        if self.bulk_delete_supported is not False:
+            single_ids = []
+            for start in range(0, len(resource_ids), BULK_DELETE_SIZE):
+                chunk = resource_ids[start:start + BULK_DELETE_SIZE]
+                if len(chunk) == 1 or self.bulk_delete_supported is False:
+                    single_ids.extend(chunk)
+                    continue
+                delete_url = "{0}1/layers/{1}.json".format(
+                    self.host, ",".join(chunk))
+                response = GISCloudNetworkHandler.blocking_request(
                     GISCloudNetworkHandler.DELETE,
-                    layer_url,
+                    delete_url,
                     self.user.apikey)
-            except Exception:
-                LOGGER.debug('Delete layers failed while deleting\
-                             layer/cache', exc_info=True)
+                if response["status_code"] in (200, 204):
+                    self.bulk_delete_supported = True
+                    single_ids.extend(
+                        self.__get_remaining_resources(chunk, response))
+                else:
+                    # other errors may be transient, bulk delete
+                    # is tried again with the next chunk
+                    if response["status_code"] in (400, 404, 405, 501) \
+                       and not self.bulk_delete_supported:
+                        LOGGER.info('Bulk delete is not supported')
+                        self.bulk_delete_supported = False
+                    single_ids.extend(chunk)
+
+        requests = [(GISCloudNetworkHandler.DELETE,
+                     "{0}1/layers/{1}.json".format(self.host, resource_id),
+                     None)
+                    for resource_id in single_ids]
+        responses = GISCloudNetworkHandler.blocking_requests(
+            requests,
+            self.user.apikey,
+            self.max_concurrent_requests)
+
+        failed = [resource_id for resource_id, response
+                  in zip(single_ids, responses)
+                  if response["status_code"] not in (200, 204, 404)]
+        if failed:
+            LOGGER.warning('Failed to delete {}'.format(failed))
+        return failed
+
+    @staticmethod
+    def __get_remaining_resources(resource_ids, response):
+        """Ids of a successful bulk delete that it hasn't confirmed.
+        204 without content means all ids were deleted, otherwise body
+        lists results per id in data as {"id": ..., "status": ...}."""
+        if response["status_code"] == 204:
+            return []
+        body = response["response"]
+        results = body.get("data") if isinstance(body, dict) else None
+        if not isinstance(results, list):
+            return resource_ids
+        deleted = set(str(result.get("id")) for result in results
+                      if isinstance(result, dict) and
+                      result.get("status") in (200, 204, 404))
+        remaining = [resource_id for resource_id in resource_ids
+                     if resource_id not in deleted]
+        if remaining:
+            LOGGER.warning('Bulk delete has left {}'.format(remaining))
+        return remaining
 
     def check_group_for_layers(self, group):
         """Checking which active layers are belonging to a group"""
@@ -199,33 +540,39 @@ class GISCloudCore(object):
         """Delete folders(groups) on GIS Cloud"""
         LOGGER.debug('Function purge_folders has started')
 
-        for group_id in self.giscloud_groups:
-            if group_id not in self.qgis_groups.values():
-                LOGGER.info("deleting group {}".format(group_id))
-                group_url = "{0}/1/layers/{1}.json".format(
-                    self.host, group_id)
-                try:
-                    GISCloudNetworkHandler.blocking_request(
-                        GISCloudNetworkHandler.DELETE,
-                        group_url,
-                        self.user.apikey)
-                except Exception:
-                    LOGGER.debug('Delete group failed', exc_info=True)
+        group_ids = [group_id for group_id in self.giscloud_groups
+                     if group_id not in self.qgis_groups.values()]
+        LOGGER.info("deleting groups {}".format(group_ids))
+        failed_ids = self.failed_deletions.setdefault(str(self.map.map_id),
+                                                      [])
+        failed_ids.extend(group_id for group_id
+                          in self.delete_resources(group_ids)
+                          if group_id not in failed_ids)
 
     def create_folders(self):
-        """Create groups as folders on GIS Cloud."""
-        self.qgis_api.group_parent = {}
+        """Create groups as folders on GIS Cloud.
+        Folder only needs its parent id, so all folders on the same tree
+        level are created or updated at once."""
         self.qgis_groups = {}
         LOGGER.debug('Function create_folder has started')
-        groups = []
-        self.qgis_api.get_groups_rec(groups,
-                                     self.qgis_api.project.layerTreeRoot())
-
-        for group in groups:
+        index = self.qgis_api.layer_tree_index.refresh()
+        self.qgis_api.group_parent = index.group_parent
 
+        levels = {}
+        for group in index.groups:
             if not self.check_group_for_layers(group):
                 continue
+            levels.setdefault(index.group_depth[group], []).append(group)
+
+        for depth in sorted(levels):
+            self.__create_folders_level(levels[depth])
+
+    def __create_folders_level(self, groups):
+        """Create or update folders of a single tree level"""
+        requests = []
+        requested_groups = []
 
+        for group in groups:
             folder_data = {"mid": int(self.map.map_id), "name": group.name(),
                            "order": self.qgis_api.tree_order[group],
                            "type": 'folder', "source": '{"qgis":1}'}
@@ -235,41 +582,51 @@ class GISCloudCore(object):
                 folder_data["parent"] = \
                     self.qgis_groups[self.qgis_api.group_parent[group]]
 
+            if group in self.giscloud_groups_map:
+                gc_group = self.giscloud_groups_map[group]
+                self.qgis_groups[group] = gc_group["id"]
+                if (folder_data["name"] != gc_group["name"] or
+                        folder_data["parent"] != gc_group["parent"] or
+                        folder_data["order"] != gc_group["order"]):
+                    LOGGER.debug('updating folder {} {}'.format(
+                        gc_group["id"], folder_data))
+                    put_url = self.host + '1/layers/' + \
+                        gc_group["id"] + '.json'
+                    requests.append((GISCloudNetworkHandler.PUT,
+                                     put_url,
+                                     folder_data))
+                    requested_groups.append((group, folder_data))
+            else:
+                LOGGER.debug('creating folder {}'.format(folder_data))
+                post_url = self.host + '1/layers.json'
+                requests.append((GISCloudNetworkHandler.POST,
+                                 post_url,
+                                 folder_data))
+                requested_groups.append((group, folder_data))
+
+        if not requests:
+            return
+
+        responses = GISCloudNetworkHandler.blocking_requests(
+            requests,
+            self.user.apikey,
+            self.max_concurrent_requests)
+
+        for (group, folder_data), request, response in \
+                zip(requested_groups, requests, responses):
             try:
-                if group in self.giscloud_groups_map:
-                    gc_group = self.giscloud_groups_map[group]
-                    if (folder_data["name"] != gc_group["name"] or
-                            folder_data["parent"] != gc_group["parent"] or
-                            folder_data["order"] != gc_group["order"]):
-
-                        LOGGER.debug('updating folder {} {}'.format(
-                            gc_group["id"], folder_data))
-                        put_url = self.host + '1/layers/' + \
-                            gc_group["id"] + '.json'
-                        response = GISCloudNetworkHandler.blocking_request(
-                            GISCloudNetworkHandler.PUT,
-                            put_url,
-                            self.user.apikey,
-                            folder_data)
-                        LOGGER.info('Folder update status code: {}'.format(
-                            response["status_code"]))
-                    self.qgis_groups[group] = gc_group["id"]
-                else:
-                    post_url = self.host + '1/layers.json'
-                    LOGGER.debug('creating folder {}'.format(folder_data))
-                    response = GISCloudNetworkHandler.blocking_request(
-                        GISCloudNetworkHandler.POST,
-                        post_url,
-                        self.user.apikey,
-                        folder_data)
-                    LOGGER.info('Folder create status code{}'.format(
+                if request[0] == GISCloudNetworkHandler.PUT:
+                    LOGGER.info('Folder update status code: {}'.format(
                         response["status_code"]))
-                    if response["status_code"] == 201:
-                        folder_id = response['location']
-                        folder_id = folder_id.split("/")[-1]
-                        self.qgis_groups[group] = folder_id
-                    else:
-                        handle_error(response)
+                    continue
+                LOGGER.info('Folder create status code{}'.format(
+                    response["status_code"]))
+                if response["status_code"] == 201:
+                    folder_id = response['location']
+                    folder_id = folder_id.split("/")[-1]
+                    self.qgis_groups[group] = folder_id
+                else:
+                    handle_error(response)
 
             except Exception:
                 LOGGER.warning('Create folder failed {}'.format(folder_data),
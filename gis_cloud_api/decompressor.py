@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Streaming decompressor for gzip and deflate encoded response bodies.
+
+"""
+
+import zlib
+
+
+class GISCloudDecompressor(object):
+    """Decompressing a body chunk by chunk. Some servers send deflate
+    as raw stream without zlib header, so the header is checked
+    in the first two bytes before decompressing."""
+
+    def __init__(self, encoding):
+        self.head = b''
+        self.decompressor = None
+        if encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @staticmethod
+    def create(encoding):
+        """Decompressor for Content-Encoding, None if body isn't
+        compressed"""
+        encoding = encoding.lower()
+        if encoding in ("gzip", "deflate"):
+            return GISCloudDecompressor(encoding)
+        return None
+
+    def decompress(self, data):
+        """Returning decompressed data that is available so far"""
+        if self.decompressor is None:
+            self.head += data
+            if len(self.head) < 2:
+                return b''
+            data = self.head
+            self.head = b''
+            cmf, flg = bytearray(data[:2])
+            if cmf & 0x0f == 8 and (cmf * 256 + flg) % 31 == 0:
+                self.decompressor = zlib.decompressobj()
+            else:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        """Returning rest of the data once the whole body is read"""
+        if self.decompressor is None:
+            return b''
+        return self.decompressor.flush()
@@ -44,3 +44,19 @@ class GISCloudException(Exception):
 
     def __init__(self, msg):
         Exception.__init__(self, msg)
+
+
+class GISCloudTimeout(GISCloudException):
+    """Raised when POST request has timed out, server may or may not
+    have processed it, so it isn't repeated"""
+
+    def __init__(self, url, reason):
+        GISCloudException.__init__(
+            self, "Request {} timed out ({})".format(url, reason))
+
+
+class GISCloudCancelled(Exception):
+    """Raised when running task has been cancelled by user"""
+
+    def __init__(self):
+        Exception.__init__(self, "Cancelled")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ JSON stream parser that yields items of a list in a JSON object
+ while the response is still being downloaded.
+
+"""
+
+import codecs
+import json
+import re
+
+SPECIAL_CHARS = re.compile(r'[\[\]{}"]')
+STRING_CHARS = re.compile(r'["\\]')
+
+
+class GISCloudJSONListStream(object):
+    """Incremental parser for responses like {"data": [{...}, {...}]}.
+    Only object items of the list under list_key are returned."""
+    # pylint: disable=R0902
+
+    def __init__(self, list_key="data"):
+        self.list_key = list_key
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = None
+        self.last_key = None
+        self.last_key_end = None
+        self.in_list = False
+        self.item_start = None
+        self.done = False
+
+    def feed(self, data):
+        """Feeding bytes, returns list items completed by them"""
+        items = []
+        if self.done:
+            return items
+        self.buffer += self.decoder.decode(data)
+
+        while not self.done:
+            if self.in_string:
+                match = STRING_CHARS.search(self.buffer, self.pos)
+                if not match:
+                    self.pos = len(self.buffer)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(self.buffer):
+                        # escaped char is in the next chunk
+                        self.pos = match.start()
+                        break
+                    self.pos = match.end() + 1
+                    continue
+                self.in_string = False
+                self.pos = match.end()
+                if self.depth == 1 and not self.in_list:
+                    self.last_key = self.buffer[self.string_start:
+                                                match.start()]
+                    self.last_key_end = self.pos
+                continue
+
+            match = SPECIAL_CHARS.search(self.buffer, self.pos)
+            if not match:
+                self.pos = len(self.buffer)
+                break
+            char = match.group()
+            self.pos = match.end()
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = self.pos
+            elif char in '[{':
+                if self.in_list and self.depth == 2 and char == '{':
+                    self.item_start = match.start()
+                elif self.__is_list_start(char, match.start()):
+                    self.in_list = True
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.in_list and self.depth == 2 and \
+                        self.item_start is not None:
+                    items.append(json.loads(
+                        self.buffer[self.item_start:self.pos]))
+                    self.item_start = None
+                elif self.in_list and self.depth == 1:
+                    self.done = True
+
+        self.__trim_buffer()
+        return items
+
+    def __is_list_start(self, char, index):
+        return char == '[' and \
+            self.depth == 1 and \
+            self.last_key == self.list_key and \
+            self.buffer[self.last_key_end:index].strip() == ':'
+
+    def __trim_buffer(self):
+        """Dropping text that is already parsed"""
+        keep = [self.pos]
+        if self.item_start is not None:
+            keep.append(self.item_start)
+        if self.in_string:
+            keep.append(self.string_start)
+        if self.depth == 1 and not self.in_list and \
+                self.last_key_end is not None:
+            keep.append(self.last_key_end)
+        else:
+            self.last_key = None
+            self.last_key_end = None
+        cut = min(keep)
+        if not cut:
+            return
+        self.buffer = self.buffer[cut:]
+        self.pos -= cut
+        if self.item_start is not None:
+            self.item_start -= cut
+        if self.in_string:
+            self.string_start -= cut
+        if self.last_key_end is not None:
+            self.last_key_end -= cut
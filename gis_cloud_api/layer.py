@@ -34,19 +34,43 @@ import json
 import os
 import zipfile
 
-from .exception import handle_error
+from .cancellation import get_current_token
+from .exception import GISCloudCancelled, handle_error
 from .network_handler import GISCloudNetworkHandler
 from ..qgis_api.logger import get_gc_publisher_logger
 from ..qgis_api.utils import GISCloudQgisUtils
 
 LOGGER = get_gc_publisher_logger(__name__)
 
+# layer state split into parts that change independently,
+# names are keys of the layer payload
+HASH_GROUPS = {"placement": ("order", "parent", "visible"),
+               "style": ("name", "alpha", "styles"),
+               "source": ("type", "source", "epsg", "x_min", "y_min",
+                          "x_max", "y_max", "datasource_id",
+                          "datasource_timestamp")}
+HASHED_ATTRIBUTES = frozenset(
+    ["mid"] + [name for names in HASH_GROUPS.values() for name in names])
+
 
 class GISCloudLayer(object):
     """Layer stores all atributes that are needed to translate it from
-    QGIS to GIS Cloud."""
+    QGIS to GIS Cloud. Hashes are cached until a hashed attribute
+    is written, attributes holding lists and dicts are replaced
+    rather than changed in place."""
+
+    __slots__ = ("id", "mid", "name", "epsg", "source", "type", "styles",
+                 "alpha", "visible", "order", "parent", "x_min", "y_min",
+                 "x_max", "y_max", "datasource_id", "datasource_object",
+                 "datasource_timestamp", "should_updata_data",
+                 "source_to_convert", "export_format", "raster_to_convert",
+                 "converted_raster", "files", "assets", "source_dir",
+                 "source_no_ext", "gc_source", "resource_id",
+                 "created_layer_id", "api", "giscloud_layer", "original_id",
+                 "full_update", "qgis_layer", "hashes")
 
     def __init__(self, gc_api):
+        self.hashes = {}
         self.id = None  # pylint: disable=C0103
         self.mid = None
         self.name = None
@@ -67,24 +91,59 @@ class GISCloudLayer(object):
         self.datasource_timestamp = 0
         self.should_updata_data = False
         self.source_to_convert = None
+        self.export_format = None
+        self.raster_to_convert = None
+        self.converted_raster = None
         self.files = []
         self.assets = []
         self.source_dir = None
+        self.source_no_ext = None
+        self.gc_source = None
         self.resource_id = None
+        self.created_layer_id = None
         self.api = gc_api
         self.giscloud_layer = {}
         self.original_id = None
         self.full_update = True
+        self.qgis_layer = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in HASHED_ATTRIBUTES:
+            object.__setattr__(self, "hashes", {})
 
     def hash(self):
         """We generate state to compare states between QGIS and GIS Cloud"""
-        hash_input = json.dumps(self.data()) + \
-            "datasource_timestamp:" + \
-            str(self.datasource_timestamp)
-        return hashlib.md5(hash_input.encode("UTF-8")).hexdigest()
+        if "full" not in self.hashes:
+            hash_input = json.dumps(self.data()) + \
+                "datasource_timestamp:" + \
+                str(self.datasource_timestamp)
+            self.hashes["full"] = \
+                hashlib.md5(hash_input.encode("UTF-8")).hexdigest()
+        return self.hashes["full"]
+
+    def group_hashes(self):
+        """Hash of each part of the layer state"""
+        for group, names in HASH_GROUPS.items():
+            if group not in self.hashes:
+                hash_input = json.dumps(
+                    [getattr(self, name) for name in names], sort_keys=True)
+                self.hashes[group] = \
+                    hashlib.md5(hash_input.encode("UTF-8")).hexdigest()
+        return dict((group, self.hashes[group]) for group in HASH_GROUPS)
+
+    def changed_groups(self):
+        """Parts of the state that differ from the layer on GIS Cloud,
+        None if GIS Cloud doesn't have group hashes for the layer"""
+        remote_hashes = self.giscloud_layer.get("hashes")
+        if not remote_hashes:
+            return None
+        return [group for group, group_hash in self.group_hashes().items()
+                if remote_hashes.get(group) != group_hash]
 
-    def data(self):
-        """Returns layer data that can be used as payload"""
+    def data(self, groups=None):
+        """Returns layer data that can be used as payload,
+        if groups are given only their fields are included"""
         data = {"mid": self.mid,
                 "order": self.order,
                 "parent": self.parent}
@@ -108,6 +167,12 @@ class GISCloudLayer(object):
             data["y_max"] = self.y_max
         if self.datasource_id is not None:
             data["datasource_id"] = self.datasource_id
+        if groups is not None:
+            names = set(["mid"])
+            for group in groups:
+                names.update(HASH_GROUPS[group])
+            data = dict((key, value) for key, value in data.items()
+                        if key in names)
         return data
 
     def create_datasource(self):
@@ -118,18 +183,21 @@ class GISCloudLayer(object):
             if ds_type not in self.api.datasources_cache:
                 get_url = "{}1/datasources.json?type={}".format(
                     self.api.host, ds_type)
-                response = GISCloudNetworkHandler.blocking_request(
-                    GISCloudNetworkHandler.GET, get_url, self.api.user.apikey)
-                self.api.datasources_cache[ds_type] = \
-                    response['response']['data']
-
-            for datasource in self.api.datasources_cache[ds_type]:
-                if GISCloudQgisUtils.deep_obj_compare(self.datasource_object,
-                                                      datasource,
-                                                      decode_json=["params"]):
-                    self.datasource_id = datasource["id"]
-                    LOGGER.info("found datasource {}".format(datasource))
-                    break
+                datasources = []
+
+                def handle_datasource(datasource):
+                    datasources.append(datasource)
+                    self.__match_datasource(datasource)
+
+                response = GISCloudNetworkHandler.blocking_list_request(
+                    get_url, self.api.user.apikey, handle_datasource)
+                if not response["complete"]:
+                    raise Exception("Failed to get datasources")
+                self.api.datasources_cache[ds_type] = datasources
+            else:
+                for datasource in self.api.datasources_cache[ds_type]:
+                    if self.__match_datasource(datasource):
+                        break
 
             if not self.datasource_id:
                 if "datasource_id" in self.giscloud_layer:
@@ -153,6 +221,16 @@ class GISCloudLayer(object):
                     self.datasource_id = response["location"].split('/')[-1]
                 LOGGER.debug(response)
 
+    def __match_datasource(self, datasource):
+        if self.datasource_id or \
+                not GISCloudQgisUtils.deep_obj_compare(self.datasource_object,
+                                                       datasource,
+                                                       decode_json=["params"]):
+            return False
+        self.datasource_id = datasource["id"]
+        LOGGER.info("found datasource {}".format(datasource))
+        return True
+
     def upload_files(self, callback):
         """File uploader"""
         zip_to_upload = None
@@ -165,6 +243,8 @@ class GISCloudLayer(object):
                              if self.should_updata_data or
                              not _file[1] in self.api.current_gc_files]
             zip_to_upload = self.__zip_files(_files_to_zip)
+        except GISCloudCancelled:
+            raise
         except Exception:
             LOGGER.error('Failed to zip file', exc_info=True)
             os.remove(zip_to_upload)
@@ -193,20 +273,28 @@ class GISCloudLayer(object):
 
         if "id" in self.giscloud_layer:
             current_layer_id = self.giscloud_layer["id"]
-            LOGGER.debug('Updating layer {}'.format(current_layer_id))
+            # only changed parts are sent, moving a layer doesn't
+            # resend its styles
+            groups = self.changed_groups()
+            self.resource_id = self.giscloud_layer["resource_id"]
+            if groups == []:
+                LOGGER.debug('Layer {} is unchanged'.format(current_layer_id))
+                return
+            LOGGER.debug('Updating layer {} {}'.format(
+                current_layer_id,
+                groups if groups is not None else "all"))
             req_url = self.api.host + '1/layers/{}.json'.format(
                 current_layer_id)
             response = GISCloudNetworkHandler.blocking_request(
                 GISCloudNetworkHandler.PUT,
                 req_url,
                 self.api.user.apikey,
-                self.data())
+                self.data(groups))
 
             if response["status_code"] != 204:
                 LOGGER.warning('Layer update {} has failed'.format(self.name),
                                exc_info=True)
                 handle_error(response)
-            self.resource_id = self.giscloud_layer["resource_id"]
             return
 
         response = GISCloudNetworkHandler.blocking_request(
@@ -223,49 +311,53 @@ class GISCloudLayer(object):
                            exc_info=True)
             handle_error(response)
         else:
-            last_layer_id = response['location'].split('/')[-1]
-            req_url = self.api.host + '1/layers/' + last_layer_id + '.json'
-            response = GISCloudNetworkHandler.blocking_request(
-                GISCloudNetworkHandler.GET,
-                req_url,
-                self.api.user.apikey)
-            if response["status_code"] == 200:
-                self.resource_id = response["response"]["resource_id"]
+            self.created_layer_id = response['location'].split('/')[-1]
+            # resource id is only needed for layer options, if server
+            # doesn't return it, it is fetched for all layers at once
+            if isinstance(response['response'], dict):
+                self.resource_id = response['response'].get('resource_id')
             LOGGER.debug('Upload layer resource id {}'.format(
                 str(self.resource_id)))
 
     def create_option(self):
-        """Storing QGIS layer information on GIS Cloud to enable updates"""
-        if self.resource_id:
-            option_value = {"id": self.original_id,
-                            "datasource_timestamp": self.datasource_timestamp,
-                            "hash": self.hash()}
-            payload = {"option_name": "QGIS_LAYER",
-                       "option_value": json.dumps(option_value),
-                       "option_type": 5}
-            if "option_id" in self.giscloud_layer:
-                if not self.full_update:
-                    return
-                request_type = GISCloudNetworkHandler.PUT
-                request_url = "{}1/resources/{}/options/{}.json".format(
-                    self.api.host,
-                    self.resource_id,
-                    self.giscloud_layer["option_id"])
-            else:
-                request_type = GISCloudNetworkHandler.POST
-                request_url = "{}1/resources/{}/options.json".format(
-                    self.api.host,
-                    self.resource_id)
-
-            response = GISCloudNetworkHandler.blocking_request(
-                request_type,
-                request_url,
-                self.api.user.apikey,
+        """Keeping QGIS layer information to enable updates, it is stored
+        on GIS Cloud for all layers at once after the sync"""
+        layer_id = self.giscloud_layer.get("id", self.created_layer_id)
+        # partial update keeps the state of the last full update
+        if layer_id and ("id" not in self.giscloud_layer or
+                         self.full_update):
+            self.api.record_layer_state(self, layer_id, self.state())
+
+    def state(self):
+        """QGIS layer information stored on GIS Cloud"""
+        return {"id": self.original_id,
+                "datasource_timestamp": self.datasource_timestamp,
+                "hash": self.hash(),
+                "hashes": self.group_hashes()}
+
+    def option_request(self):
+        """Request storing state as QGIS_LAYER option of the layer,
+        used for maps without the manifest"""
+        return GISCloudLayer.state_option_request(
+            self.api.host,
+            self.resource_id,
+            self.state(),
+            self.giscloud_layer.get("option_id"))
+
+    @staticmethod
+    def state_option_request(host, resource_id, state, option_id=None):
+        """Request storing given state as QGIS_LAYER option"""
+        payload = {"option_name": "QGIS_LAYER",
+                   "option_value": json.dumps(state),
+                   "option_type": 5}
+        if option_id:
+            return (GISCloudNetworkHandler.PUT,
+                    "{}1/resources/{}/options/{}.json".format(
+                        host, resource_id, option_id),
+                    payload)
+        return (GISCloudNetworkHandler.POST,
+                "{}1/resources/{}/options.json".format(host, resource_id),
                 payload)
-            if not response["status_code"] in (201, 204):
-                LOGGER.error('Failed to create option, status code {}'.format(
-                    response["status_code"]))
-                handle_error(response)
 
     def __zip_files(self, files):
         """Zip given layer data and assets."""
@@ -282,8 +374,15 @@ class GISCloudLayer(object):
         zipfile_handle = zipfile.ZipFile(zip_file_name,
                                          mode='w',
                                          compression=zipfile.ZIP_DEFLATED)
-        for _file in files:
-            zipfile_handle.write(_file[0], _file[1])
+        token = get_current_token()
+        try:
+            for _file in files:
+                token.check()
+                zipfile_handle.write(_file[0], _file[1])
+        except GISCloudCancelled:
+            zipfile_handle.close()
+            os.remove(zip_file_name)
+            raise
         zipfile_handle.close()
         LOGGER.debug('Function zip_files finished')
         return zip_file_name
@@ -31,8 +31,10 @@
 
 import hashlib
 import math
+import numbers
 import re
 
+from qgis.core import QgsExpression
 from qgis.core import QgsPalLayerSettings, QgsRenderContext, QgsUnitTypes
 from qgis.utils import iface
 
@@ -41,13 +43,17 @@ from ..qgis_api.logger import get_gc_publisher_logger
 
 if ISQGIS3:
     from qgis.core import QgsFillSymbol, QgsRuleBasedRenderer
+    from qgis.core import QgsCategorizedSymbolRenderer
+    from qgis.core import QgsGraduatedSymbolRenderer
 else:
     from qgis.core import QgsFillSymbolV2, QgsRuleBasedRendererV2
+    from qgis.core import QgsCategorizedSymbolRendererV2
+    from qgis.core import QgsGraduatedSymbolRendererV2
 
 if ISQGIS3:
-    from PyQt5.QtCore import QSize
+    from PyQt5.QtCore import QSize, QVariant
 else:
-    from PyQt4.QtCore import QSize
+    from PyQt4.QtCore import QSize, QVariant
 
 LOGGER = get_gc_publisher_logger(__name__)
 
@@ -116,15 +122,17 @@ class GISCloudLayerStyle(object):
         styles = []
         tmp_dir = self.gc_api.qgis_api.tmp_dir
 
+        # labels and layer filter are the same for every class
         if ISQGIS3:
-            renderer = QgsRuleBasedRenderer.convertFromRenderer(
-                self.qgis_layer.renderer())
+            labels = self.qgis_layer.labeling().settings() \
+                if self.qgis_layer.labelsEnabled() else None
         else:
-            renderer = QgsRuleBasedRendererV2.convertFromRenderer(
-                self.qgis_layer.rendererV2())
+            labels = QgsPalLayerSettings()
+            labels.readFromLayer(self.qgis_layer)
+        subset_expression = self.qgis_layer.subsetString().replace('"', '')
 
-        for rule in renderer.rootRule().children():
-            symbol = rule.symbol()
+        for (symbol, filter_expression, label,
+             minimum_scale, maximum_scale) in self.get_style_classes():
             sym_size = 0
             if self.layer.type[0] == "point":
                 for layer_sym in symbol.symbolLayers():
@@ -143,16 +151,9 @@ class GISCloudLayerStyle(object):
                 temp_style = layer_sym.properties()
                 self.convert_units_to_px(temp_style)
 
-                val_label = None
                 # in case of multiple symbolLayers()
                 # labels should be set only once
-                if is_first_sym:
-                    if ISQGIS3:
-                        if self.qgis_layer.labelsEnabled():
-                            val_label = self.qgis_layer.labeling().settings()
-                    else:
-                        val_label = QgsPalLayerSettings()
-                        val_label.readFromLayer(self.qgis_layer)
+                val_label = labels if is_first_sym else None
                 style = {}
                 line_style = "line_style"
                 line_width = 0
@@ -327,21 +328,10 @@ class GISCloudLayerStyle(object):
                                         " to {0}".format(style['fontname']))
                         self.setup_label_offset(val_label, style)
 
-                if rule.filterExpression():
-                    style['expression'] = rule.filterExpression().replace('"',
-                                                                          '')
-                    expressionEqualIndex = re.search(' = ', style['expression'])
-
-                    if expressionEqualIndex:
-                        expressionEqualIndex = expressionEqualIndex.span()
-                        columnName = style['expression'][:expressionEqualIndex[0]]
-                        layer = iface.activeLayer()
+                if filter_expression:
+                    style['expression'] = filter_expression.replace('"', '')
 
-                        for i in layer.attributeTableConfig().columns():
-                            if i.name == columnName and layer.fields().field(columnName).typeName() == "String" and style['expression'][expressionEqualIndex[1]:].isnumeric():
-                                style['expression'] = style['expression'][:expressionEqualIndex[1]] + "\'" + style['expression'][expressionEqualIndex[1]:] + "\'"
-
-                expression = self.qgis_layer.subsetString().replace('"', '')
+                expression = subset_expression
                 if expression and expression != '':
                     if 'expression' in style and style['expression'] != '':
                         style['expression'] = "(" + \
@@ -349,8 +339,8 @@ class GISCloudLayerStyle(object):
                                               ") AND (" + expression + ")"
                     else:
                         style['expression'] = expression
-                if rule.label():
-                    style['label'] = rule.label()
+                if label:
+                    style['label'] = label
                 style['showlabel'] = 't' \
                                      if val_label is not None and \
                                      'labelfield' in style \
@@ -359,18 +349,18 @@ class GISCloudLayerStyle(object):
 
                 if self.qgis_layer.hasScaleBasedVisibility():
                     factor = dpi * inches_per_meter * max_scale_per_pixel
-                    if ISQGIS3 and rule.minimumScale() > 0:
+                    if minimum_scale > 0:
                         style['fromlevel'] = \
                             int(round(
-                                math.log((factor / rule.minimumScale()), 2),
+                                math.log((factor / minimum_scale), 2),
                                 0))
                     elif layer_fromlevel > 0:
                         style['fromlevel'] = layer_fromlevel
 
-                    if ISQGIS3 and rule.maximumScale() > 0:
+                    if maximum_scale > 0:
                         style['tolevel'] = \
                             int(round(
-                                math.log((factor / rule.maximumScale()), 2),
+                                math.log((factor / maximum_scale), 2),
                                 0))
                     elif layer_tolevel > 0:
                         style['tolevel'] = layer_tolevel
@@ -405,6 +395,116 @@ class GISCloudLayerStyle(object):
         LOGGER.debug('Finished map_styles function')
         return styles
 
+    def get_style_classes(self):
+        """Symbols of the layer with their filter expression, label and
+        minimum and maximum scale. Categorized and graduated renderers
+        are read directly, other renderers are converted to rule-based.
+        Every class is still sent as its own style, GIS Cloud styles
+        have no compact class table yet."""
+        if ISQGIS3:
+            renderer = self.qgis_layer.renderer()
+            categorized = QgsCategorizedSymbolRenderer
+            graduated = QgsGraduatedSymbolRenderer
+        else:
+            renderer = self.qgis_layer.rendererV2()
+            categorized = QgsCategorizedSymbolRendererV2
+            graduated = QgsGraduatedSymbolRendererV2
+
+        classes = None
+        if isinstance(renderer, categorized):
+            classes = self.get_categorized_classes(renderer)
+        elif isinstance(renderer, graduated):
+            classes = self.get_graduated_classes(renderer)
+        if classes is not None:
+            for style_class in classes:
+                yield style_class
+            return
+
+        if ISQGIS3:
+            renderer = QgsRuleBasedRenderer.convertFromRenderer(renderer)
+        else:
+            renderer = QgsRuleBasedRendererV2.convertFromRenderer(renderer)
+
+        string_fields = self.get_string_fields()
+        for rule in renderer.rootRule().children():
+            expression = rule.filterExpression().replace('"', '')
+            # numeric values of text fields have to be quoted
+            equal_index = re.search(' = ', expression)
+            if equal_index and \
+               expression[:equal_index.start()] in string_fields and \
+               expression[equal_index.end():].isnumeric():
+                expression = "{}'{}'".format(
+                    expression[:equal_index.end()],
+                    expression[equal_index.end():])
+            if ISQGIS3:
+                yield (rule.symbol(), expression, rule.label(),
+                       rule.minimumScale(), rule.maximumScale())
+            else:
+                yield (rule.symbol(), expression, rule.label(), 0, 0)
+
+    def get_categorized_classes(self, renderer):
+        """Classes of a categorized renderer, expressions are the same as
+        in rule-based conversion. Returns None for category values that
+        can't be written as expression literals."""
+        attribute = renderer.classAttribute()
+        column = self.get_class_column(attribute)
+        quote_numbers = attribute in self.get_string_fields()
+        # like QGIS, only Int values are written unquoted
+        field_index = self.qgis_layer.fields().indexFromName(attribute)
+        quote_integers = field_index >= 0 and \
+            self.qgis_layer.fields().field(field_index).type() in \
+            (QVariant.UInt, QVariant.LongLong, QVariant.ULongLong)
+
+        classes = []
+        for category in renderer.categories():
+            value = category.value()
+            if isinstance(value, (list, tuple)):
+                values = [format_category_value(item, quote_numbers, True)
+                          for item in value]
+                if None in values:
+                    return None
+                expression = "{} IN ({})".format(column, ",".join(values)) \
+                    if values else "ELSE"
+            else:
+                value = format_category_value(value,
+                                              quote_numbers or quote_integers)
+                if value is None:
+                    return None
+                if value == "''":
+                    # empty or null category matches everything else
+                    expression = "ELSE"
+                else:
+                    expression = "{} = {}".format(column, value)
+            classes.append((category.symbol(), expression, category.label(),
+                            0, 0))
+        return classes
+
+    def get_graduated_classes(self, renderer):
+        """Classes of a graduated renderer, the first range includes
+        its lower value"""
+        column = self.get_class_column(renderer.classAttribute())
+        classes = []
+        for index, class_range in enumerate(renderer.ranges()):
+            expression = "{0} {1} {2:f} AND {0} <= {3:f}".format(
+                column,
+                ">=" if index == 0 else ">",
+                class_range.lowerValue(),
+                class_range.upperValue())
+            classes.append((class_range.symbol(), expression,
+                            class_range.label(), 0, 0))
+        return classes
+
+    def get_class_column(self, attribute):
+        """Class attribute is either a field name or an expression"""
+        if self.qgis_layer.fields().indexFromName(attribute) >= 0:
+            return QgsExpression.quotedColumnRef(attribute)
+        return attribute
+
+    def get_string_fields(self):
+        """Names of the layer text fields"""
+        return set(field.name() for field in self.qgis_layer.fields()
+                   if field.typeName() == "String")
+
     def dump_symbol_properties(self, symbol):
         """This is recursive method that gathers properties from subsymbols"""
         properties = ""
@@ -494,6 +594,25 @@ class GISCloudLayerStyle(object):
             style['labelplacement'] = 'TL'
 
 
+def format_category_value(value, quote_numbers, in_list=False):
+    """Category value as an expression literal the way rule-based
+    conversion writes it, None if unsupported. Null is written as
+    an empty string, values of a list keep full precision."""
+    if value is None or isinstance(value, QVariant) and value.isNull():
+        return "''"
+    if isinstance(value, bool):
+        return QgsExpression.quotedString(str(value).lower())
+    if isinstance(value, numbers.Integral):
+        text = str(value)
+    elif isinstance(value, numbers.Real):
+        text = str(value) if in_list else "{:.4f}".format(value)
+    elif isinstance(value, (str, type(u""))):
+        return QgsExpression.quotedString(value)
+    else:
+        return None
+    return QgsExpression.quotedString(text) if quote_numbers else text
+
+
 def rgb_int2tuple(rgbint):
     """Convert RGB integer to corresponding RGB tuple."""
     return '{},{},{}'.format(rgbint // 256 // 256 % 256,
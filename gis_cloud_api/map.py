@@ -29,6 +29,8 @@
 
 """
 
+import json
+
 from .exception import handle_error
 from .network_handler import GISCloudNetworkHandler
 from ..qgis_api.logger import get_gc_publisher_logger
@@ -46,6 +48,9 @@ class GISCloudMap(object):
         self.map_name = None
         self.map_id = None
         self.is_map_public = False
+        self.resource_id = None
+        self.manifest_option_id = None
+        self.manifest_supported = None
 
     def get_unique_map_name(self, query, count=1, maps=None):
         """Find maps by name, used to build a unique map name on GIS Cloud"""
@@ -60,12 +65,14 @@ class GISCloudMap(object):
                            "&order_by=accessed:desc&query_on=name" +
                            "&query={1}&type=private").format(
                                self.gc_api.host, query)
-                response = GISCloudNetworkHandler.blocking_request(
-                    GISCloudNetworkHandler.GET,
+                maps = []
+                # only names are kept from the listing
+                response = GISCloudNetworkHandler.blocking_list_request(
                     get_url,
-                    self.gc_api.user.apikey)
-                if response["status_code"] == 200:
-                    maps = response["response"]["data"]
+                    self.gc_api.user.apikey,
+                    lambda gc_map: maps.append({"name": gc_map["name"]}))
+                if not response["complete"]:
+                    return None
 
             for gc_map in maps:
                 if gc_map["name"] == unique_map_name:
@@ -77,9 +84,94 @@ class GISCloudMap(object):
             LOGGER.info('Failed while getting maps', exc_info=True)
             return None
 
+    def get_manifest(self):
+        """Reading sync manifest stored as an option of the map,
+        returns None if the map doesn't have one"""
+        self.resource_id = None
+        self.manifest_option_id = None
+        map_url = '{0}1/maps/{1}.json?expand=options'.format(
+            self.gc_api.host, self.map_id)
+        response = GISCloudNetworkHandler.blocking_request(
+            GISCloudNetworkHandler.GET,
+            map_url,
+            self.gc_api.user.apikey)
+        if response["status_code"] != 200 or not response["response"]:
+            return None
+
+        self.resource_id = response["response"].get("resource_id")
+        for option in response["response"].get("options") or []:
+            if option["option_name"] == "QGIS_MANIFEST":
+                self.manifest_option_id = option["id"]
+                self.manifest_supported = True
+                try:
+                    return json.loads(option["option_value"])
+                except ValueError:
+                    LOGGER.warning('Invalid sync manifest', exc_info=True)
+        return None
+
+    def save_manifest(self, manifest):
+        """Storing sync manifest in a single request,
+        returns False if it couldn't be stored"""
+        if not self.resource_id:
+            map_url = '{0}1/maps/{1}.json'.format(
+                self.gc_api.host, self.map_id)
+            response = GISCloudNetworkHandler.blocking_request(
+                GISCloudNetworkHandler.GET,
+                map_url,
+                self.gc_api.user.apikey)
+            if response["status_code"] != 200:
+                return False
+            self.resource_id = response["response"]["resource_id"]
+
+        payload = {"option_name": "QGIS_MANIFEST",
+                   "option_value": json.dumps(manifest),
+                   "option_type": 5}
+        if self.manifest_option_id:
+            request_type = GISCloudNetworkHandler.PUT
+            request_url = "{}1/resources/{}/options/{}.json".format(
+                self.gc_api.host, self.resource_id, self.manifest_option_id)
+        else:
+            request_type = GISCloudNetworkHandler.POST
+            request_url = "{}1/resources/{}/options.json".format(
+                self.gc_api.host, self.resource_id)
+
+        response = GISCloudNetworkHandler.blocking_request(
+            request_type,
+            request_url,
+            self.gc_api.user.apikey,
+            payload)
+        if response["status_code"] not in (201, 204):
+            LOGGER.warning('Failed to store sync manifest, status code {}'
+                           .format(response["status_code"]))
+            if response["status_code"] in (400, 403, 404, 405, 501):
+                self.manifest_supported = False
+            return False
+        if response["location"]:
+            self.manifest_option_id = response["location"].split('/')[-1]
+        self.manifest_supported = True
+        return True
+
+    def delete_manifest(self):
+        """Removing sync manifest, returns False if it couldn't be removed"""
+        if not self.manifest_option_id:
+            return True
+        response = GISCloudNetworkHandler.blocking_request(
+            GISCloudNetworkHandler.DELETE,
+            "{}1/resources/{}/options/{}.json".format(
+                self.gc_api.host, self.resource_id, self.manifest_option_id),
+            self.gc_api.user.apikey)
+        if response["status_code"] not in (200, 204, 404):
+            LOGGER.error('Failed to remove sync manifest, status code {}'
+                         .format(response["status_code"]))
+            return False
+        self.manifest_option_id = None
+        return True
+
     def detach_map(self):
         """Deatch a map if user wants to publish as a new map"""
         self.map_id = None
+        self.resource_id = None
+        self.manifest_option_id = None
         self.qgis_api.project.removeEntry('giscloud_project', 'save_as')
 
     def update_map(self):
@@ -121,6 +213,8 @@ class GISCloudMap(object):
             payload)
         if response["status_code"] == 201:
             self.map_id = int(response['location'].split('/')[-1])
+            self.resource_id = None
+            self.manifest_option_id = None
         else:
             handle_error(response)
 
@@ -132,10 +226,10 @@ class GISCloudMap(object):
                 map_url,
                 self.gc_api.user.apikey)
 
-            resource_id = response['response']['resource_id']
+            self.resource_id = response['response']['resource_id']
             payload = {"username": "anonymous", "permission": "READ"}
             post_url = '{0}1/resources/{1}/permission.json'.format(
-                self.gc_api.host, resource_id)
+                self.gc_api.host, self.resource_id)
             GISCloudNetworkHandler.blocking_request(
                 GISCloudNetworkHandler.POST,
                 post_url,
@@ -36,9 +36,19 @@
 import json
 import platform
 import os
+import time
+import zlib
 
 from qgis.core import QgsNetworkAccessManager
 
+from .cancellation import get_current_token
+from .decompressor import GISCloudDecompressor
+from .exception import GISCloudTimeout
+from .json_stream import GISCloudJSONListStream
+from .reply_watchdog import GISCloudReplyWatchdog
+from .throttle import GISCloudLatencyProbe, GISCloudThrottledFile
+from .throttle import GISCloudUploadThrottle
+from ..qgis_api.logger import get_gc_publisher_logger
 from ..qgis_api.version import ISQGIS3
 from ..qgis_api.version import GIS_CLOUD_PUBLISHER_VERSION, QGIS_VERSION
 
@@ -49,6 +59,8 @@ else:
     from PyQt4.QtCore import QByteArray, QEventLoop, QFile, QIODevice, QUrl
     from PyQt4 import QtNetwork
 
+LOGGER = get_gc_publisher_logger(__name__)
+
 
 class GISCloudNetworkHandler(object):
     """GIS Cloud helper class that doest REST requests on the API"""
@@ -67,9 +79,44 @@ class GISCloudNetworkHandler(object):
                               QByteArray(b'application/json'))
     default_request.setRawHeader(QByteArray(b'X-GIS-CLOUD-APP'),
                                  QByteArray(app_id.encode("utf-8")))
+    # with header set explicitly Qt doesn't decompress on its own,
+    # so we can count bytes saved by compression
+    default_request.setRawHeader(QByteArray(b'Accept-Encoding'),
+                                 QByteArray(b'gzip, deflate'))
+    default_request.setAttribute(
+        QtNetwork.QNetworkRequest.HttpPipeliningAllowedAttribute, True)
+    if hasattr(QtNetwork.QNetworkRequest, "Http2AllowedAttribute"):
+        default_request.setAttribute(
+            QtNetwork.QNetworkRequest.Http2AllowedAttribute, True)
 
     reply_handlers = {}
 
+    # bytes per second, updated after each upload
+    upload_rate = 1024.0 * 1024.0
+
+    # count and total seconds of TLS handshakes of new connections,
+    # from sending a request until its connection is encrypted,
+    # and of metadata requests without their handshakes
+    handshake_latency = [0, 0.0]
+    request_latency = [0, 0.0]
+
+    # bytes on the wire and uncompressed bytes
+    transfer_bytes = {"received": [0, 0], "sent": [0, 0]}
+
+    # JSON bodies above this size are sent gzipped once the server
+    # has advertised it accepts them (Accept-Encoding in a response,
+    # RFC 7694), None means it hasn't yet
+    compress_requests_min_size = 4096
+    compressed_requests_supported = None
+
+    # seconds per endpoint class, None disables the timeout,
+    # POSTs are never aborted on the total timeout
+    timeouts = {"metadata": {"connect": 20, "idle": 30, "total": 120},
+                "upload": {"connect": 20, "idle": 60, "total": None}}
+    max_retries = 2
+
+    upload_throttle = GISCloudUploadThrottle()
+
     def __init__(self, reply, handle_reply, handle_error=None):
         self.reply = reply
         self.handle_reply = handle_reply
@@ -87,7 +134,8 @@ class GISCloudNetworkHandler(object):
         status_code = self.reply.attribute(
             QtNetwork.QNetworkRequest.HttpStatusCodeAttribute)
         try:
-            data = json.loads(self.reply.readAll().data().decode("utf-8"))
+            data = json.loads(GISCloudNetworkHandler.read_body(
+                self.reply).decode("utf-8"))
         except Exception:
             data = None
 
@@ -155,15 +203,12 @@ class GISCloudNetworkHandler(object):
         return handler
 
     @staticmethod
-    def blocking_request(request_type, url, key, payload=None,
-                         default_request=None, progress_callback=None):
-        """This is an universal blocking request method we use in threads"""
+    def send_request(request_type, url, key, payload=None,
+                     default_request=None, compress=False):
+        """Sending a request without waiting for the reply"""
         # pylint: disable=R0913
         nam = QgsNetworkAccessManager.instance()
 
-        if payload and not default_request:
-            payload = QByteArray(json.dumps(payload).encode("utf-8"))
-
         if not default_request:
             default_request = GISCloudNetworkHandler.default_request
         req = QtNetwork.QNetworkRequest(default_request)
@@ -171,6 +216,21 @@ class GISCloudNetworkHandler(object):
                          QByteArray(str(key).encode("utf-8")))
         req.setUrl(QUrl(url))
 
+        if payload and default_request is \
+                GISCloudNetworkHandler.default_request:
+            payload = json.dumps(payload).encode("utf-8")
+            raw_size = len(payload)
+            if compress:
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                payload = compressor.compress(payload) + compressor.flush()
+                req.setRawHeader(QByteArray(b'Content-Encoding'),
+                                 QByteArray(b'gzip'))
+            GISCloudNetworkHandler.count_bytes("sent",
+                                               len(payload),
+                                               raw_size)
+            payload = QByteArray(payload)
+
         if request_type == GISCloudNetworkHandler.POST:
             reply = nam.post(req, payload)
         elif request_type == GISCloudNetworkHandler.PUT:
@@ -179,32 +239,351 @@ class GISCloudNetworkHandler(object):
             reply = nam.deleteResource(req)
         else:
             reply = nam.get(req)
+        return reply
 
-        loop = QEventLoop()
-        if progress_callback:
-            reply.uploadProgress.connect(progress_callback)
-        reply.finished.connect(loop.quit)
-        reply.error.connect(loop.quit)
-        loop.exec_()
+    @staticmethod
+    def count_bytes(direction, wire_size, raw_size):
+        """Counting transferred bytes, direction is sent or received"""
+        GISCloudNetworkHandler.transfer_bytes[direction][0] += wire_size
+        GISCloudNetworkHandler.transfer_bytes[direction][1] += raw_size
+
+    @staticmethod
+    def read_body(reply):
+        """Reading reply body and decompressing it if needed"""
+        data = reply.readAll().data()
+        wire_size = len(data)
+        decompressor = GISCloudDecompressor.create(
+            reply.rawHeader(QByteArray(b'Content-Encoding'))
+            .data().decode("utf-8"))
+        if data and decompressor:
+            data = decompressor.decompress(data) + decompressor.flush()
+        GISCloudNetworkHandler.count_bytes("received", wire_size, len(data))
+        return data
 
+    @staticmethod
+    def parse_reply(reply):
+        """Reading status code, JSON response and location from a reply"""
         result = {}
         result["status_code"] = reply.attribute(
             QtNetwork.QNetworkRequest.HttpStatusCodeAttribute)
 
         try:
             result["response"] = json.loads(
-                reply.readAll().data().decode("utf-8"))
+                GISCloudNetworkHandler.read_body(reply).decode("utf-8"))
         except Exception:
             result["response"] = None
 
         location = reply.rawHeader(QByteArray(b'Location'))
         result["location"] = \
             location.data().decode("utf-8") if location else None
+
+        accept_encoding = reply.rawHeader(QByteArray(b'Accept-Encoding'))
+        if GISCloudNetworkHandler.compressed_requests_supported is None \
+                and "gzip" in accept_encoding.data().decode("utf-8").lower():
+            GISCloudNetworkHandler.compressed_requests_supported = True
+        return result
+
+    @staticmethod
+    def warm_up(url):
+        """Opening connection to the API host ahead of the first request,
+        so that TLS handshake isn't paid by the request itself.
+        Network access manager is per thread, so this has to be called
+        from the thread that is going to send requests."""
+        nam = QgsNetworkAccessManager.instance()
+        host = QUrl(url)
+        nam.connectToHostEncrypted(host.host(), host.port(443))
+
+    @staticmethod
+    def time_handshake(reply, start_time):
+        """Timing TLS handshake of a reply that opens a new connection,
+        encrypted isn't emitted for reused connections. Time in seconds
+        is kept under "time", it stays None if there was no handshake."""
+        timing = {"time": None}
+        # encrypted signal isn't available in Qt 4
+        if hasattr(reply, "encrypted"):
+            def handle_encrypted():
+                timing["time"] = time.time() - start_time
+            reply.encrypted.connect(handle_encrypted)
+        return timing
+
+    @staticmethod
+    def record_latency(reply, elapsed, handshake=None):
+        """Keeping track of TLS handshake and request latency apart,
+        handshake is in seconds or None for a reused connection"""
+        if handshake is not None:
+            GISCloudNetworkHandler.handshake_latency[0] += 1
+            GISCloudNetworkHandler.handshake_latency[1] += handshake
+            elapsed -= handshake
+        GISCloudNetworkHandler.request_latency[0] += 1
+        GISCloudNetworkHandler.request_latency[1] += elapsed
+
+        http2 = False
+        if hasattr(QtNetwork.QNetworkRequest, "Http2WasUsedAttribute"):
+            http2 = reply.attribute(
+                QtNetwork.QNetworkRequest.Http2WasUsedAttribute)
+        LOGGER.debug('{} took {:.0f} ms{}{}'.format(
+            reply.url().path(),
+            elapsed * 1000,
+            " after {:.0f} ms TLS handshake".format(handshake * 1000)
+            if handshake is not None else "",
+            " (HTTP/2)" if http2 else ""))
+
+    @staticmethod
+    def get_timeouts(request_type, endpoint_class):
+        """Timeouts of a request, POST may have been processed by the
+        server already, so it isn't aborted on the total timeout"""
+        timeouts = GISCloudNetworkHandler.timeouts[endpoint_class]
+        if request_type == GISCloudNetworkHandler.POST:
+            timeouts = dict(timeouts, total=None)
+        return timeouts
+
+    @staticmethod
+    def blocking_request(request_type, url, key, payload=None,
+                         default_request=None, progress_callback=None,
+                         retries=0):
+        """This is an universal blocking request method we use in threads.
+        Requests that time out are retried unless they are POSTs."""
+        # pylint: disable=R0913,R0914
+        start_time = time.time()
+
+        compress = \
+            payload and not default_request and \
+            GISCloudNetworkHandler.compressed_requests_supported and \
+            len(json.dumps(payload)) >= \
+            GISCloudNetworkHandler.compress_requests_min_size
+        token = get_current_token()
+        token.check()
+        reply = GISCloudNetworkHandler.send_request(request_type,
+                                                    url,
+                                                    key,
+                                                    payload,
+                                                    default_request,
+                                                    compress)
+        handshake = GISCloudNetworkHandler.time_handshake(reply, start_time)
+        token.register(reply)
+        watchdog = GISCloudReplyWatchdog(
+            reply,
+            GISCloudNetworkHandler.get_timeouts(
+                request_type,
+                "upload" if progress_callback else "metadata"))
+
+        loop = QEventLoop()
+        if progress_callback:
+            reply.uploadProgress.connect(progress_callback)
+        reply.finished.connect(loop.quit)
+        reply.error.connect(loop.quit)
+        loop.exec_()
+        watchdog.stop()
+        token.unregister(reply)
+        token.check()
+
+        if not progress_callback:
+            GISCloudNetworkHandler.record_latency(reply,
+                                                  time.time() - start_time,
+                                                  handshake["time"])
+        result = GISCloudNetworkHandler.parse_reply(reply)
+        result["timed_out"] = watchdog.timed_out
+
+        if watchdog.timed_out:
+            # POST is not idempotent and upload body can't be resent,
+            # callers decide if it is safe to repeat it
+            if request_type == GISCloudNetworkHandler.POST:
+                raise GISCloudTimeout(url, watchdog.timed_out)
+            if retries < GISCloudNetworkHandler.max_retries:
+                LOGGER.info('Retrying {}'.format(url))
+                return GISCloudNetworkHandler.blocking_request(
+                    request_type, url, key, payload, default_request,
+                    progress_callback, retries + 1)
+            return result
+
+        if compress:
+            if result["status_code"] in (400, 415):
+                # server might not understand compressed body,
+                # so we try again without compression
+                LOGGER.info('Retrying request without compression')
+                GISCloudNetworkHandler.compressed_requests_supported = False
+                result = GISCloudNetworkHandler.blocking_request(
+                    request_type, url, key, payload, default_request,
+                    progress_callback, retries)
+                if result["status_code"] in (400, 415):
+                    GISCloudNetworkHandler.compressed_requests_supported = \
+                        None
         return result
 
+    @staticmethod
+    def blocking_list_request(url, key, handle_item, list_key="data",
+                              etag=None):
+        """Blocking GET request for JSON list endpoints, handle_item is
+        called for every item of the list as soon as it is downloaded,
+        so the whole response is never held in memory.
+        With etag the request is conditional and status 304 means
+        the list hasn't changed."""
+        start_time = time.time()
+        token = get_current_token()
+        token.check()
+        request = None
+        if etag:
+            request = QtNetwork.QNetworkRequest(
+                GISCloudNetworkHandler.default_request)
+            request.setRawHeader(QByteArray(b'If-None-Match'),
+                                 QByteArray(etag.encode("utf-8")))
+        reply = GISCloudNetworkHandler.send_request(
+            GISCloudNetworkHandler.GET, url, key, default_request=request)
+        handshake = GISCloudNetworkHandler.time_handshake(reply, start_time)
+        token.register(reply)
+        watchdog = GISCloudReplyWatchdog(
+            reply, GISCloudNetworkHandler.timeouts["metadata"])
+
+        stream = GISCloudJSONListStream(list_key)
+        state = {"decompressor": None, "error": None}
+
+        def read_chunk(last=False):
+            if state["error"] or reply.attribute(
+                    QtNetwork.QNetworkRequest.HttpStatusCodeAttribute) != 200:
+                return
+            data = reply.readAll().data()
+            wire_size = len(data)
+            if state["decompressor"] is None:
+                state["decompressor"] = GISCloudDecompressor.create(
+                    reply.rawHeader(QByteArray(b'Content-Encoding'))
+                    .data().decode("utf-8")) or False
+            if state["decompressor"]:
+                data = state["decompressor"].decompress(data)
+                if last:
+                    data += state["decompressor"].flush()
+            GISCloudNetworkHandler.count_bytes("received",
+                                               wire_size,
+                                               len(data))
+            try:
+                for item in stream.feed(data):
+                    handle_item(item)
+            except Exception as exception:
+                # exceptions can't leave Qt slots,
+                # so we stop the download and raise it later
+                state["error"] = exception
+                reply.abort()
+
+        loop = QEventLoop()
+        reply.readyRead.connect(read_chunk)
+        reply.finished.connect(loop.quit)
+        reply.error.connect(loop.quit)
+        loop.exec_()
+        watchdog.stop()
+        token.unregister(reply)
+        token.check()
+        read_chunk(True)
+
+        GISCloudNetworkHandler.record_latency(reply,
+                                              time.time() - start_time,
+                                              handshake["time"])
+        if state["error"]:
+            raise state["error"]
+
+        return {"status_code": reply.attribute(
+            QtNetwork.QNetworkRequest.HttpStatusCodeAttribute),
+                "response": None,
+                "location": None,
+                "complete": stream.done,
+                "etag": reply.rawHeader(
+                    QByteArray(b'ETag')).data().decode("utf-8") or None,
+                "timed_out": watchdog.timed_out}
+
+    @staticmethod
+    def blocking_requests(requests, key, max_concurrency=6):
+        """Running several requests at once and waiting for all of them.
+        Requests are (request_type, url, payload) tuples, at most
+        max_concurrency of them are in flight. Results are returned
+        in the same order as requests."""
+        results = [None] * len(requests)
+        pending = list(enumerate(requests))
+        in_flight = {}
+        loop = QEventLoop()
+        token = get_current_token()
+
+        def send_next():
+            while pending and len(in_flight) < max_concurrency and \
+                    not token.cancelled:
+                index, (request_type, url, payload) = pending.pop(0)
+                reply = GISCloudNetworkHandler.send_request(request_type,
+                                                            url,
+                                                            key,
+                                                            payload)
+                in_flight[reply] = (index, GISCloudReplyWatchdog(
+                    reply, GISCloudNetworkHandler.get_timeouts(
+                        request_type, "metadata")))
+                token.register(reply)
+                reply.finished.connect(
+                    lambda reply=reply: handle_finished(reply))
+
+        def handle_finished(reply):
+            index, watchdog = in_flight.pop(reply)
+            watchdog.stop()
+            token.unregister(reply)
+            results[index] = GISCloudNetworkHandler.parse_reply(reply)
+            results[index]["timed_out"] = watchdog.timed_out
+            reply.deleteLater()
+            send_next()
+            if not in_flight:
+                loop.quit()
+
+        token.check()
+        send_next()
+        if in_flight:
+            loop.exec_()
+        token.check()
+        return results
+
     @staticmethod
     def upload_file(file_to_upload, post_url, key, callback):
-        """Method for uploading files to GIS Cloud"""
+        """Method for uploading files to GIS Cloud.
+        Upload that stalls is started again, file in storage is
+        overwritten so it is safe to repeat it."""
+        request = QtNetwork.QNetworkRequest()
+        request.setRawHeader(QByteArray(b'X-GIS-CLOUD-APP'),
+                             GISCloudNetworkHandler.app_id.encode("utf-8"))
+        throttle = GISCloudNetworkHandler.upload_throttle
+        throttled = throttle.current_rate() is not None
+        # adaptive throttle learns only from latency during uploads
+        probe = GISCloudLatencyProbe(post_url, throttle) \
+            if throttle.adaptive else None
+        if probe:
+            probe.start()
+        try:
+            result, elapsed = GISCloudNetworkHandler.__upload_attempts(
+                file_to_upload, post_url, key, callback, request)
+        finally:
+            if probe:
+                probe.stop()
+        if result["status_code"] in (200, 201, 204) and elapsed > 0:
+            size = os.path.getsize(file_to_upload)
+            GISCloudNetworkHandler.upload_rate = size / elapsed
+            throttle.record_upload(size, elapsed, throttled)
+        return result
+
+    @staticmethod
+    def __upload_attempts(file_to_upload, post_url, key, callback, request):
+        # stalled upload is started again, elapsed time is of the last try
+        for attempt in range(GISCloudNetworkHandler.max_retries + 1):
+            if attempt:
+                LOGGER.info('Retrying upload of {}'.format(file_to_upload))
+            start_time = time.time()
+            try:
+                result = GISCloudNetworkHandler.blocking_request(
+                    GISCloudNetworkHandler.POST,
+                    post_url,
+                    key,
+                    GISCloudNetworkHandler.get_multi_part(file_to_upload),
+                    request,
+                    callback)
+                break
+            except GISCloudTimeout:
+                if attempt == GISCloudNetworkHandler.max_retries:
+                    raise
+        return result, time.time() - start_time
+
+    @staticmethod
+    def get_multi_part(file_to_upload):
+        """Multipart body with the file, it can be sent only once"""
         zip_part = QtNetwork.QHttpPart()
         zip_part_content_disposition = QByteArray(
             'form-data; name="upfile"; filename="{}"'
@@ -214,7 +593,11 @@ class GISCloudNetworkHandler(object):
         zip_part.setHeader(QtNetwork.QNetworkRequest.ContentDispositionHeader,
                            zip_part_content_disposition)
 
-        file_handler = QFile(file_to_upload)
+        if GISCloudNetworkHandler.upload_throttle.enabled():
+            file_handler = GISCloudThrottledFile(
+                file_to_upload, GISCloudNetworkHandler.upload_throttle)
+        else:
+            file_handler = QFile(file_to_upload)
         file_handler.open(QIODevice.ReadOnly)
         zip_part.setBodyDevice(file_handler)
 
@@ -222,20 +605,15 @@ class GISCloudNetworkHandler(object):
             QtNetwork.QHttpMultiPart.FormDataType)
         file_handler.setParent(multi_part)
         multi_part.append(zip_part)
-
-        request = QtNetwork.QNetworkRequest()
-        request.setRawHeader(QByteArray(b'X-GIS-CLOUD-APP'),
-                             GISCloudNetworkHandler.app_id.encode("utf-8"))
-        result = GISCloudNetworkHandler.blocking_request(
-            GISCloudNetworkHandler.POST,
-            post_url,
-            key,
-            multi_part,
-            request,
-            callback)
-        return result
+        return multi_part
 
     @staticmethod
     def cancel():
         """"Cancel all current network requests"""
+        handlers = list(GISCloudNetworkHandler.reply_handlers.keys())
         GISCloudNetworkHandler.reply_handlers = {}
+        for handler in handlers:
+            # callbacks are not called for aborted requests
+            handler.handle_reply = None
+            handler.handle_error = None
+            handler.reply.abort()
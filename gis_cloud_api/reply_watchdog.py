@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Watchdog that aborts network replies which stopped making progress.
+
+"""
+
+import time
+
+from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import QTimer
+else:
+    from PyQt4.QtCore import QTimer
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+
+class GISCloudReplyWatchdog(object):
+    """Aborting a reply on connect, idle or total timeout.
+    Timeouts are in seconds, None disables a timeout. Reply is idle
+    when neither uploaded nor downloaded bytes change. Once the whole
+    request body is sent the server may be processing it, so the reply
+    isn't considered idle anymore."""
+
+    check_interval = 500
+
+    def __init__(self, reply, timeouts):
+        self.reply = reply
+        self.timeouts = timeouts
+        self.started = time.time()
+        self.last_progress = None
+        self.transferred = {"upload": 0, "download": 0}
+        self.body_sent = False
+        self.timed_out = None
+
+        reply.metaDataChanged.connect(self.__connected)
+        reply.uploadProgress.connect(self.__uploaded)
+        reply.downloadProgress.connect(self.__downloaded)
+
+        self.timer = QTimer()
+        self.timer.setInterval(GISCloudReplyWatchdog.check_interval)
+        self.timer.timeout.connect(self.check)
+        self.timer.start()
+
+    def __connected(self):
+        if self.last_progress is None:
+            self.last_progress = time.time()
+
+    def __uploaded(self, bytes_sent, bytes_total):
+        self.__progress("upload", bytes_sent)
+        if 0 < bytes_total <= bytes_sent:
+            self.body_sent = True
+
+    def __downloaded(self, bytes_received, _):
+        self.__progress("download", bytes_received)
+
+    def __progress(self, direction, transferred):
+        if transferred != self.transferred[direction] or \
+                self.last_progress is None:
+            self.transferred[direction] = transferred
+            self.last_progress = time.time()
+
+    def check(self):
+        """Aborting the reply if any of the timeouts has passed"""
+        now = time.time()
+        reason = None
+        if self.last_progress is None:
+            if self.__expired("connect", now - self.started):
+                reason = "connect"
+        elif not self.body_sent and \
+                self.__expired("idle", now - self.last_progress):
+            reason = "idle"
+        if self.__expired("total", now - self.started):
+            reason = "total"
+
+        if reason:
+            self.timed_out = reason
+            self.stop()
+            LOGGER.warning('{} timed out ({}) after {:.0f} s'.format(
+                self.reply.url().path(), reason, now - self.started))
+            self.reply.abort()
+
+    def __expired(self, timeout, elapsed):
+        return self.timeouts.get(timeout) is not None and \
+            elapsed > self.timeouts[timeout]
+
+    def stop(self):
+        """Stopping the watchdog once reply has finished"""
+        self.timer.stop()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Upload bandwidth limiting: token bucket on the uploaded file,
+ time of day profiles and adaptive back off.
+
+"""
+
+import time
+
+from qgis.core import QgsNetworkAccessManager
+
+from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import QFile, QIODevice, QTimer, QUrl
+    from PyQt5.QtNetwork import QNetworkRequest
+else:
+    from PyQt4.QtCore import QFile, QIODevice, QTimer, QUrl
+    from PyQt4.QtNetwork import QNetworkRequest
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+# seconds that a single read may wait for the bucket to refill
+MAX_READ_WAIT = 0.005
+
+
+def parse_schedule(schedule):
+    """Parsing "8-18:256;18-8:0" into [(8, 18, 256), (18, 8, 0)],
+    hours are local, rates are in KB/s and 0 means unlimited"""
+    profiles = []
+    for profile in schedule.split(";"):
+        if not profile.strip():
+            continue
+        try:
+            hours, rate = profile.split(":")
+            start, end = hours.split("-")
+            profiles.append((int(start), int(end), float(rate)))
+        except ValueError:
+            LOGGER.warning('Invalid upload schedule {}'.format(profile))
+    return profiles
+
+
+class GISCloudUploadThrottle(object):
+    """Deciding how fast uploads may go right now.
+    In adaptive mode the rate is cut when latency measured by
+    GISCloudLatencyProbe during uploads rises above twice the best one
+    and slowly restored when it falls back (AIMD)."""
+
+    def __init__(self):
+        self.rate_limit = 0
+        self.schedule = []
+        self.adaptive = False
+        self.factor = 1.0
+        self.best_rtt = None
+        self.average_rtt = None
+        self.link_rate = None
+
+    def configure(self, options):
+        """Applying upload options read from the project"""
+        self.rate_limit = options["upload_rate_limit"]
+        self.schedule = parse_schedule(options["upload_schedule"])
+        self.adaptive = options["upload_adaptive"]
+        if not self.adaptive:
+            self.factor = 1.0
+
+    def enabled(self):
+        """Uploads need to go through the throttle"""
+        return bool(self.rate_limit or self.schedule or self.adaptive)
+
+    def configured_rate(self):
+        """Rate from the time of day profile or the global limit, KB/s"""
+        hour = time.localtime().tm_hour
+        for start, end, rate in self.schedule:
+            if start <= hour < end or \
+                    (start > end and (hour >= start or hour < end)):
+                return rate
+        return self.rate_limit
+
+    def current_rate(self):
+        """Upload rate in bytes per second, None when unlimited"""
+        rate = self.configured_rate() * 1024.0
+        if self.adaptive and self.factor < 1.0:
+            # without a limit we back off from the measured link rate
+            rate = (rate or self.link_rate or 0) * self.factor
+        return rate or None
+
+    def record_rtt(self, rtt):
+        """Feeding time to first byte of a latency probe"""
+        if not self.adaptive:
+            return
+        self.best_rtt = rtt if self.best_rtt is None \
+            else min(self.best_rtt, rtt)
+        self.average_rtt = rtt if self.average_rtt is None \
+            else 0.8 * self.average_rtt + 0.2 * rtt
+        if self.average_rtt > 2 * self.best_rtt:
+            self.factor = max(0.1, self.factor * 0.7)
+            LOGGER.debug('Upload rate backed off to {:.0%}'.format(
+                self.factor))
+        else:
+            self.factor = min(1.0, self.factor + 0.1)
+
+    def record_upload(self, size, elapsed, throttled):
+        """Remembering link rate from uploads that were not limited"""
+        if not throttled and elapsed > 0:
+            self.link_rate = size / elapsed
+
+
+class GISCloudLatencyProbe(object):
+    """Measuring latency while an upload is running. A HEAD request
+    to the API host is sent every interval milliseconds, one at a time,
+    and its time to first byte is fed to the throttle. Probe has to be
+    started in the thread that runs the upload event loop."""
+
+    interval = 2000
+
+    def __init__(self, url, throttle):
+        host = QUrl(url)
+        self.url = QUrl("{}://{}/".format(host.scheme(), host.host()))
+        self.throttle = throttle
+        self.reply = None
+        self.sent = None
+        self.timer = QTimer()
+        self.timer.setInterval(GISCloudLatencyProbe.interval)
+        self.timer.timeout.connect(self.__send)
+
+    def start(self):
+        """Probing until stop, first probe goes out right away"""
+        self.__send()
+        self.timer.start()
+
+    def stop(self):
+        """Stopping the probe together with the upload"""
+        self.timer.stop()
+        if self.reply is not None:
+            reply = self.reply
+            self.reply = None
+            reply.abort()
+            reply.deleteLater()
+
+    def __send(self):
+        if self.reply is not None:
+            return
+        self.sent = time.time()
+        self.reply = QgsNetworkAccessManager.instance().head(
+            QNetworkRequest(self.url))
+        self.reply.metaDataChanged.connect(self.__first_byte)
+        self.reply.finished.connect(self.__finished)
+
+    def __first_byte(self):
+        if self.sent is not None:
+            self.throttle.record_rtt(time.time() - self.sent)
+            self.sent = None
+
+    def __finished(self):
+        if self.reply is not None:
+            self.reply.deleteLater()
+            self.reply = None
+
+
+class GISCloudThrottledFile(QIODevice):
+    """Read only file device that hands out bytes no faster than
+    the throttle allows. Qt reads the upload body in the thread that
+    sent the request, so waits are kept short to let its event loop
+    handle aborts and timeouts between chunks."""
+
+    def __init__(self, file_name, throttle, parent=None):
+        QIODevice.__init__(self, parent)
+        self.file = QFile(file_name, self)
+        self.throttle = throttle
+        self.tokens = 0.0
+        self.last_refill = time.time()
+
+    def open(self, mode):
+        """Opening the file for reading"""
+        return self.file.open(QIODevice.ReadOnly) and \
+            QIODevice.open(self, mode)
+
+    def close(self):
+        """Closing the file"""
+        self.file.close()
+        QIODevice.close(self)
+
+    def size(self):
+        """Size of the file"""
+        return self.file.size()
+
+    def isSequential(self):  # pylint: disable=C0103
+        """File can be seeked, so Qt knows the body size"""
+        return False
+
+    def seek(self, pos):
+        """Seeking the file together with the device"""
+        return self.file.seek(pos) and QIODevice.seek(self, pos)
+
+    def readData(self, maxlen):  # pylint: disable=C0103
+        """Reading at most a tenth of a second worth of bytes, or less
+        if the bucket doesn't refill within a short wait"""
+        maxlen = min(maxlen, self.file.size() - self.file.pos())
+        rate = self.throttle.current_rate()
+        if rate and maxlen > 0:
+            maxlen = min(maxlen, max(4096, int(rate / 10)))
+            maxlen = self.__take_tokens(maxlen, rate)
+        # PyQt returns bytes from read
+        return self.file.read(maxlen)
+
+    def writeData(self, _):  # pylint: disable=C0103
+        """Device is read only"""
+        return -1
+
+    def __take_tokens(self, size, rate):
+        """Returns how many bytes may be read now, at least one.
+        Waits are capped, so the event loop runs between reads."""
+        self.__refill(size, rate)
+        if self.tokens < size:
+            time.sleep(min(MAX_READ_WAIT, (size - self.tokens) / rate))
+            self.__refill(size, rate)
+        allowed = max(1, min(size, int(self.tokens)))
+        self.tokens -= allowed
+        return allowed
+
+    def __refill(self, size, rate):
+        now = time.time()
+        # bucket holds at most one second of data
+        self.tokens = min(max(rate, size),
+                          self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
@@ -32,12 +32,14 @@
 import json
 import os
 import os.path
+import time
 
 from qgis.gui import QgsDockWidget
 
 from .gis_cloud_api.core import GISCloudCore
 from .gis_cloud_api.network_handler import GISCloudNetworkHandler
 from .qgis_api.core import GISCloudQgisCore
+from .qgis_api.event_aggregator import GISCloudQgisEventAggregator
 from .qgis_api.layer_event import GISCloudQgisLayerEvent
 from .qgis_api.logger import gc_publisher_loggers_unload
 from .qgis_api.logger import get_gc_publisher_logger
@@ -46,25 +48,31 @@ from .qgis_api.version import ISQGIS3
 from .ui.login import GISCloudUiLogin
 from .ui.publish import GISCloudUiPublish
 from .ui.update import GISCloudUiUpdate
+from .workers.analysis_scheduler import GISCloudAnalysisScheduler
 from .workers.check_connection import GISCloudWorkerCheckConnection
-from .workers.map_analysis import GISCloudWorkerMapAnalysis
 
 if ISQGIS3:
-    from .ui import resources5  # noqa:F401 pylint:disable=unused-import
-else:
-    from .ui import resources4  # noqa:F401 pylint:disable=unused-import
-
-if ISQGIS3:
-    from PyQt5.QtCore import Qt, QEvent, QObject, QSize, QTimer
+    from PyQt5.QtCore import Qt, QEvent, QObject, QSize
     from PyQt5.QtGui import QIcon
     from PyQt5.QtWidgets import QAction, QMessageBox
 else:
-    from PyQt4.QtCore import Qt, QEvent, QObject, QSize, QTimer
+    from PyQt4.QtCore import Qt, QEvent, QObject, QSize
     from PyQt4.QtGui import QAction, QIcon, QMessageBox
 
 LOGGER = get_gc_publisher_logger(__name__)
 
 
+def load_resources():
+    """Registering compiled Qt resources (icons, loader animation).
+    Resource modules are large, so we import them only once the dock
+    is about to be shown instead of at plugin load."""
+    # pylint: disable=unused-import,import-outside-toplevel
+    if ISQGIS3:
+        from .ui import resources5  # noqa:F401
+    else:
+        from .ui import resources4  # noqa:F401
+
+
 class GISCloudPublisher(QObject):
     """This class controls all plugin-related GUI elements."""
 
@@ -89,7 +97,7 @@ class GISCloudPublisher(QObject):
         self.update_control = None
         self.check_task = None
         self.map_analysis_task = None
-        self.analysis_timer = None
+        self.event_aggregator = None
         self.action = None
         self.gui_initialized = False
 
@@ -124,6 +132,7 @@ class GISCloudPublisher(QObject):
     def initGui(self):
         """initialize the gui"""
         # pylint: disable=C0103
+        start_time = time.time()
         self.gui_initialized = True
         self.qgis_api = GISCloudQgisCore(self.path)
         self.api = GISCloudCore(self.path, self.qgis_api, self)
@@ -131,6 +140,49 @@ class GISCloudPublisher(QObject):
 
         self.message_box = QMessageBox()
 
+        self.check_task = GISCloudWorkerCheckConnection(self.api,
+                                                        self.qgis_api)
+        self.check_task.alertSignal.connect(self.__notify_user_publish)
+        self.check_task.wrongApiSignal.connect(self.__wrong_api_notify)
+
+        self.map_analysis_task = GISCloudAnalysisScheduler(self.qgis_api)
+        self.map_analysis_task.result.connect(self.__store_remote_snapshot)
+        if ISQGIS3:
+            self.map_analysis_task.result.connect(
+                self.__handle_project_update_test)
+
+        self.event_aggregator = GISCloudQgisEventAggregator(
+            self.__run_analysis)
+
+        self.main_widget = QgsDockWidget("Publisher")
+        self.main_widget.setFixedSize(QSize(360, 310))
+        self.main_widget.setObjectName("GISCloudPublisherMainDockWidget")
+
+        # icon is read from disk, so resources don't have to be
+        # registered before the dock is opened for the first time
+        self.action = QAction(
+            QIcon(os.path.join(self.path, "ui", "img", "icon.png")),
+            "GIS Cloud Publisher",
+            self.iface.mainWindow())
+        self.action.triggered.connect(self.__toggle_dock)
+        self.iface.addPluginToWebMenu("&GIS Cloud Publisher", self.action)
+
+        self.main_widget.opened.connect(self.__dock_widget_opened)
+        self.main_widget.closed.connect(self.__dock_widget_closed)
+        self.iface.addDockWidget(Qt.LeftDockWidgetArea, self.main_widget)
+
+        LOGGER.info("initGui finished in {:.1f} ms".format(
+            (time.time() - start_time) * 1000))
+
+    def init_controls(self):
+        """Loading resources and building dock forms.
+        This is done on the first dock open to keep QGIS startup fast."""
+        if self.login_control:
+            return
+
+        start_time = time.time()
+        load_resources()
+
         self.login_control = GISCloudUiLogin(self)
         self.publish_control = GISCloudUiPublish(self)
         self.update_control = GISCloudUiUpdate(self)
@@ -147,23 +199,6 @@ class GISCloudPublisher(QObject):
             for component in components:
                 component.installEventFilter(self)
 
-        self.check_task = GISCloudWorkerCheckConnection(self.api,
-                                                        self.qgis_api)
-        self.check_task.alertSignal.connect(self.__notify_user_publish)
-        self.check_task.wrongApiSignal.connect(self.__wrong_api_notify)
-
-        self.map_analysis_task = GISCloudWorkerMapAnalysis(self.qgis_api)
-        if ISQGIS3:
-            self.map_analysis_task.result.connect(
-                self.__handle_project_update_test)
-
-        self.analysis_timer = QTimer()
-        self.analysis_timer.timeout.connect(self.__run_analysis)
-
-        self.main_widget = QgsDockWidget("Publisher")
-        self.main_widget.setFixedSize(QSize(360, 310))
-        self.main_widget.setObjectName("GISCloudPublisherMainDockWidget")
-
         self.login_control.is_auth = self.api.user.is_auth_api()
         if self.login_control.is_auth:
             self.set_dock_widget(self.publish_control.publish_dock)
@@ -172,16 +207,8 @@ class GISCloudPublisher(QObject):
             if ISQGIS3:
                 self.login_control.login_dock.username.setFocus()
 
-        self.action = QAction(
-            QIcon(":/plugins/gis_cloud_publisher/ui/img/icon.png"),
-            "GIS Cloud Publisher",
-            self.iface.mainWindow())
-        self.action.triggered.connect(self.__toggle_dock)
-        self.iface.addPluginToWebMenu("&GIS Cloud Publisher", self.action)
-
-        self.main_widget.opened.connect(self.__dock_widget_opened)
-        self.main_widget.closed.connect(self.__dock_widget_closed)
-        self.iface.addDockWidget(Qt.LeftDockWidgetArea, self.main_widget)
+        LOGGER.info("Dock forms loaded in {:.1f} ms".format(
+            (time.time() - start_time) * 1000))
 
     def eventFilter(self, obj, event):
         """This is needed to filter events and hook on palette change,
@@ -324,14 +351,20 @@ class GISCloudPublisher(QObject):
             self.__project_check()
 
     def handle_project_update(self):
-        """Starting the analysis with a 50msec throttle"""
-        if self.login_control.is_auth:
-            self.analysis_timer.start(50)
+        """Scheduling the analysis after a project or layer tree change"""
+        if self.login_control and self.login_control.is_auth:
+            self.event_aggregator.notify()
+
+    def handle_layer_update(self, layer_id):
+        """Scheduling the analysis after a layer change"""
+        if self.login_control and self.login_control.is_auth:
+            self.event_aggregator.notify(layer_id)
 
     def __dock_widget_opened(self):
         """Handling widget open"""
         if self.main_widget_opened:
             return
+        self.init_controls()
         self.main_widget_opened = True
 
         self.read_project.connect(self.__load_project)
@@ -357,6 +390,8 @@ class GISCloudPublisher(QObject):
     def unload(self):
         """Unload the plugin."""
         self.gui_initialized = False
+        self.event_aggregator.reset()
+        self.map_analysis_task.stop()
         GISCloudNetworkHandler.cancel()
         gc_publisher_loggers_unload()
         self.__dock_widget_closed()
@@ -445,9 +480,10 @@ class GISCloudPublisher(QObject):
                 layer.dataSourceChanged.connect(event_handler.handle_data_change)
 
             for hook in self.layer_hooks:
-                if hasattr(layer, hook):
+                if hasattr(layer, hook) and \
+                   not GISCloudQgisEventAggregator.is_render_only(hook):
                     signal = getattr(layer, hook)
-                    signal.connect(self.handle_project_update)
+                    signal.connect(event_handler.handle_state_change)
 
     def __unhook_on_layer_events(self, layers):
         for layer in layers:
@@ -471,9 +507,10 @@ class GISCloudPublisher(QObject):
                 layer.dataSourceChanged.disconnect(event_handler.handle_data_change)
 
             for hook in self.layer_hooks:
-                if hasattr(layer, hook):
+                if hasattr(layer, hook) and \
+                   not GISCloudQgisEventAggregator.is_render_only(hook):
                     signal = getattr(layer, hook)
-                    signal.disconnect(self.handle_project_update)
+                    signal.disconnect(event_handler.handle_state_change)
 
     def __unhook_all_events(self, unhook_layer_events=True):
         if unhook_layer_events or ISQGIS3:
@@ -521,6 +558,15 @@ class GISCloudPublisher(QObject):
                         'state')[0]
                     self.qgis_api.layer_data_timestamps = json.loads(
                         layer_data_timestamps) if layer_data_timestamps else {}
+                    export_format_choices = self.qgis_api.project.readEntry(
+                        'giscloud_layers_export_format',
+                        'state')[0]
+                    self.qgis_api.export_format_choices = json.loads(
+                        export_format_choices) \
+                        if export_format_choices else {}
+                    self.api.restore_failed_deletions()
+                    # status is shown from the stored listing right away
+                    self.api.restore_remote_snapshot()
                     if not ISQGIS3:
                         self.set_dock_widget(
                             self.update_control.update_dock)
@@ -578,6 +624,7 @@ class GISCloudPublisher(QObject):
         if self.main_widget.isUserVisible():
             self.main_widget.close()
         else:
+            self.init_controls()
             self.main_widget.show()
 
     def __handle_project_update_test(self, result):
@@ -596,7 +643,12 @@ class GISCloudPublisher(QObject):
             self.set_dock_widget(self.update_control.update_done_dock)
             self.set_login_info(self.update_control.update_done_dock.user)
 
-    def __run_analysis(self):
-        """Running layer analysis with a throttle."""
-        self.analysis_timer.stop()
-        self.map_analysis_task.start()
+    def __store_remote_snapshot(self, result):
+        # pylint: disable=W0613
+        self.api.store_remote_snapshot()
+
+    def __run_analysis(self, dirty_layers):
+        """Running layer analysis once event burst has settled."""
+        LOGGER.debug("Running analysis for {} dirty layers".format(
+            len(dirty_layers)))
+        self.map_analysis_task.request(dirty_layers)
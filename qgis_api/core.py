@@ -37,15 +37,18 @@ import os
 import os.path
 import re
 
-from difflib import SequenceMatcher
-
 from qgis.core import QgsMapLayer, QgsProject, QgsUnitTypes
-from qgis.core import QgsLayerTreeGroup, QgsLayerTreeLayer, QgsVectorLayer
+from qgis.core import QgsVectorLayer
 from qgis.utils import iface
 
+from .export_formats import choose_export_format, get_export_format
+from .export_formats import is_export_format_available
+from .layer_order import plan_orders
+from .layer_tree_index import GISCloudLayerTreeIndex
 from .logger import get_gc_publisher_logger
 from .utils import GISCloudQgisUtils
 from .version import ISQGIS3
+from ..gis_cloud_api.cancellation import get_current_token
 from ..gis_cloud_api.layer import GISCloudLayer
 from ..gis_cloud_api.layer_style import GISCloudLayerStyle
 
@@ -53,9 +56,9 @@ if not ISQGIS3:
     from qgis.core import QGis
 
 if ISQGIS3:
-    from PyQt5.QtCore import Qt, QFileInfo
+    from PyQt5.QtCore import QFileInfo
 else:
-    from PyQt4.QtCore import Qt, QFileInfo
+    from PyQt4.QtCore import QFileInfo
 
 LOGGER = get_gc_publisher_logger(__name__)
 
@@ -69,6 +72,7 @@ class GISCloudQgisCore(object):
         self.tmp_dir_len = len(self.tmp_dir)
         self.gc_api = None
         self.tree_order = {}
+        self.layer_tree_index = GISCloudLayerTreeIndex()
         self.map_name = None
         self.map_name_override = None
         self.project = None
@@ -77,6 +81,7 @@ class GISCloudQgisCore(object):
         self.use_all_layers = True
         self.last_analysis = {"time": 0}
         self.layer_data_timestamps = {}
+        self.export_format_choices = {}
         self.layers_to_upload_ids = {}
         self.group_parent = {}
         self.supported_file_source_vector = [
@@ -87,11 +92,97 @@ class GISCloudQgisCore(object):
             'jpeg', 'tif', 'tiff', 'jpg',
             'gif', 'sid', 'hgt', 'dem', 'ecw',
             'img', 'jp2', 'pdf', 'png']
+        self.export_options = {}
+        self.upload_options = {}
         self.init_project()
 
     def init_project(self):
         """Initialize project instance"""
         self.project = QgsProject.instance()
+        self.layer_tree_index.attach(self.project.layerTreeRoot())
+        self.read_export_options()
+        self.read_upload_options()
+
+    def read_export_options(self):
+        """Reading optional export settings stored in the project.
+
+        raster_cog - convert file rasters to tiled GeoTIFFs aligned to
+        web mercator with internal overviews before upload
+        vector_reproject - reproject vector layers to the map CRS
+        vector_precision - snap vertices to a grid of this size (map units)
+        vector_simplify_scale - simplify geometries for this scale
+        vector_used_fields_only - export only fields used by styles, labels
+        and map tips, plus fields listed in vector_fields_allowlist
+        vector_spatialite - write SpatiaLite with a spatial index and
+        features sorted along a Hilbert curve, using vector_page_size
+        vector_format - name of a registered export format or "auto" to
+        pick the fastest one, overrides vector_spatialite"""
+        self.export_options = {
+            "raster_cog": self.project.readBoolEntry(
+                "giscloud_export", "raster_cog", False)[0],
+            "vector_reproject": self.project.readBoolEntry(
+                "giscloud_export", "vector_reproject", False)[0],
+            "vector_precision": self.project.readDoubleEntry(
+                "giscloud_export", "vector_precision", 0.0)[0],
+            "vector_simplify_scale": self.project.readDoubleEntry(
+                "giscloud_export", "vector_simplify_scale", 0.0)[0],
+            "vector_used_fields_only": self.project.readBoolEntry(
+                "giscloud_export", "vector_used_fields_only", False)[0],
+            "vector_fields_allowlist": self.project.readEntry(
+                "giscloud_export", "vector_fields_allowlist", "")[0],
+            "vector_spatialite": self.project.readBoolEntry(
+                "giscloud_export", "vector_spatialite", False)[0],
+            "vector_page_size": self.project.readNumEntry(
+                "giscloud_export", "vector_page_size", 8192)[0],
+            "vector_format": self.project.readEntry(
+                "giscloud_export", "vector_format", "")[0]}
+
+    def read_upload_options(self):
+        """Reading optional upload bandwidth settings stored in the project.
+
+        upload_rate_limit - maximum upload rate in KB/s, 0 is unlimited
+        upload_schedule - time of day profiles that override the limit,
+        e.g. "8-18:256;18-8:0" is 256 KB/s during work hours
+        upload_adaptive - slow uploads down when API responses slow down"""
+        self.upload_options = {
+            "upload_rate_limit": self.project.readDoubleEntry(
+                "giscloud_upload", "upload_rate_limit", 0.0)[0],
+            "upload_schedule": self.project.readEntry(
+                "giscloud_upload", "upload_schedule", "")[0],
+            "upload_adaptive": self.project.readBoolEntry(
+                "giscloud_upload", "upload_adaptive", False)[0]}
+
+    def vector_profile_enabled(self):
+        """Vector layers are rewritten on export when reprojection,
+        snapping, simplification, field filtering or other output format
+        is turned on"""
+        return ISQGIS3 and bool(
+            self.export_options["vector_reproject"] or
+            self.export_options["vector_spatialite"] or
+            self.export_options["vector_format"] not in ("", "sqlite") or
+            self.export_options["vector_used_fields_only"] or
+            self.export_options["vector_precision"] > 0 or
+            self.export_options["vector_simplify_scale"] > 0)
+
+    def get_export_format(self, layer, benchmark=False):
+        """Format that vector layer is converted to before upload.
+        Automatic choice is benchmarked only when syncing and is kept
+        per layer, so the converted source doesn't change between runs."""
+        name = self.export_options["vector_format"]
+        if not name and self.export_options["vector_spatialite"]:
+            name = "spatialite"
+        if not ISQGIS3:
+            name = "sqlite"
+        if name == "auto":
+            choice = self.export_format_choices.get(layer.id())
+            if choice and is_export_format_available(choice):
+                return get_export_format(choice)
+            if not benchmark:
+                return get_export_format("sqlite")
+            export_format = choose_export_format(layer, self.tmp_dir)
+            self.export_format_choices[layer.id()] = export_format["name"]
+            return export_format
+        return get_export_format(name)
 
     def get_map_name(self, use_override=False):
         """Return map_name from project instance fileName."""
@@ -107,26 +198,26 @@ class GISCloudQgisCore(object):
 
     def get_tree_order(self):
         """Retrieving layer/group ordering."""
-        self.tree_order = {}
-        root = self.project.layerTreeRoot()
-
-        max_order = self.get_tree_order_rec(root, 0)
-
-        for i in self.tree_order:
-            self.tree_order[i] = max_order - self.tree_order[i] + 1
-
-    def get_tree_order_rec(self, root, order):
-        """Recursive method for retrieving tree order"""
-        for child in root.children():
-            order = order + 1
-            if child and isinstance(child, QgsLayerTreeGroup):
-                self.tree_order[child] = order
-                order = self.get_tree_order_rec(child, order)
-
-            elif isinstance(child, QgsLayerTreeLayer) and child.layer():
-                self.tree_order[child.layer()] = order
-
-        return order
+        self.tree_order = dict(self.layer_tree_index.refresh().tree_order)
+
+    def plan_tree_order(self):
+        """Replacing tree order with orders that keep GIS Cloud order of
+        layers and folders that didn't move, returns layers that moved"""
+        items = sorted(self.tree_order, key=self.tree_order.get)
+        remote_orders = {}
+        for item in items:
+            if item in self.gc_api.giscloud_groups_map:
+                remote_orders[item] = \
+                    self.gc_api.giscloud_groups_map[item]["order"]
+            elif isinstance(item, QgsMapLayer) and \
+                    item.id() in self.layers_to_update:
+                remote_orders[item] = \
+                    self.layers_to_update[item.id()]["order"]
+
+        self.tree_order = plan_orders(items, remote_orders)
+        return [item for item in remote_orders
+                if isinstance(item, QgsMapLayer) and
+                self.tree_order[item] != remote_orders[item]]
 
     def get_layers_to_upload(self, for_publish):
         """ Filter all layers that are not supported, not checked as visible or
@@ -144,12 +235,7 @@ class GISCloudQgisCore(object):
             provider_type = layer.providerType().lower()
             ext = layer.source().split('.')[-1].lower()
 
-            if ISQGIS3:
-                is_visible = self.project.layerTreeRoot().findLayer(
-                    layer.id()).itemVisibilityChecked()
-            else:
-                is_visible = self.project.layerTreeRoot().findLayer(
-                    layer.id()).isVisible() != Qt.Unchecked
+            is_visible = self.layer_tree_index.is_visible(layer.id())
 
             full_update = self.use_all_layers or not for_publish or is_visible
             if (full_update or layer.id() in self.layers_to_update) and \
@@ -195,7 +281,8 @@ class GISCloudQgisCore(object):
                     elif provider_type == "wms":
                         self.create_wms_layer(layer, layer_object)
                     else:
-                        self.create_general_layer(layer, layer_object)
+                        self.create_general_layer(layer, layer_object,
+                                                  for_publish)
 
                 self.layers_to_upload.insert(0, layer_object)
 
@@ -205,8 +292,7 @@ class GISCloudQgisCore(object):
 
         for layer_object in self.layers_to_upload:
             layer = layer_object.qgis_layer
-            group = GISCloudQgisUtils.get_qgis_layer_parent(layer,
-                                                            self.project)
+            group = self.layer_tree_index.parent(layer.id())
             parent = None
             if group:
                 parent = self.gc_api.qgis_groups[group]
@@ -230,7 +316,7 @@ class GISCloudQgisCore(object):
                 elif provider_type == "wms":
                     self.create_wms_layer(layer, layer_object)
                 else:
-                    self.create_general_layer(layer, layer_object)
+                    self.create_general_layer(layer, layer_object, True)
 
             layers_all.append(layer_object)
             LOGGER.info('get_layers_file_source has finished')
@@ -265,10 +351,11 @@ class GISCloudQgisCore(object):
                 'epsg': epsg,
                 'units': units}
 
-    def create_general_layer(self, layer, layer_object):
+    def create_general_layer(self, layer, layer_object, benchmark=False):
         """Processing Raster and Vector layers.
            Vector formats that aren't supported directly by GIS Cloud are
            converted to SQLlite format that GIS Cloud can read.
+           benchmark - automatic export format may be benchmarked
         """
         if layer.type() not in (QgsMapLayer.RasterLayer,
                                 QgsMapLayer.VectorLayer):
@@ -280,13 +367,30 @@ class GISCloudQgisCore(object):
         if (layer.type() == QgsMapLayer.VectorLayer and
                 (not os.path.isfile(source) or
                  not source.split('.')[-1].lower() in
-                 self.supported_file_source_vector)):
-            source = u'{0}/{1}.{2}'.format(self.tmp_dir,
-                                           layer.id(),
-                                           'sqlite')
+                 self.supported_file_source_vector or
+                 self.vector_profile_enabled())):
+            layer_object.export_format = self.get_export_format(layer,
+                                                               benchmark)
+            source = u'{0}/{1}.{2}'.format(
+                self.tmp_dir,
+                layer.id(),
+                layer_object.export_format["extension"])
             layer_object.source_to_convert = u'{0}/{1}'.format(
                 self.tmp_dir,
                 layer.id())
+            if self.vector_profile_enabled() and \
+               GISCloudQgisUtils.get_export_crs(
+                   layer, self.project, self.export_options) != layer.crs():
+                layer_object.epsg = self.get_project_crs()["epsg"]
+        elif (layer.type() == QgsMapLayer.RasterLayer and
+              self.export_options["raster_cog"] and
+              os.path.isfile(source)):
+            layer_object.raster_to_convert = source
+            source = u'{0}/{1}.{2}'.format(self.tmp_dir,
+                                           layer.id(),
+                                           'tif')
+            layer_object.converted_raster = source
+            layer_object.epsg = "3857"
 
         GISCloudQgisUtils.find_layer_source(layer, layer_object, source, self.tmp_dir_len)
         layer_object.source = {"type": "file",
@@ -393,14 +497,6 @@ class GISCloudQgisCore(object):
 
         LOGGER.info("wfs layer obj {}".format(layer_object))
 
-    def get_groups_rec(self, groups, root):
-        """Getting all groups in QGIS to recreate them on GIS Cloud"""
-        for child in root.children():
-            if isinstance(child, QgsLayerTreeGroup):
-                self.group_parent[child] = root
-                self.get_groups_rec(groups, child)
-                groups.insert(0, child)
-
     def check_layers_for_updates(self, result):
         """Check if layer has to be updated."""
         count = 0
@@ -410,8 +506,7 @@ class GISCloudQgisCore(object):
         for layer_object in self.layers_to_upload:
             layer = layer_object.qgis_layer
             order = self.tree_order[layer]
-            group = GISCloudQgisUtils.get_qgis_layer_parent(layer,
-                                                            self.project)
+            group = self.layer_tree_index.parent(layer.id())
             parent = None
             if group:
                 parent = self.gc_api.qgis_groups[group]
@@ -433,10 +528,10 @@ class GISCloudQgisCore(object):
 
     def check_folders_for_updates(self, result):
         """Check if group has to be updated."""
-        groups = []
         self.gc_api.qgis_groups = {}
-        self.group_parent = {}
-        self.get_groups_rec(groups, self.project.layerTreeRoot())
+        index = self.layer_tree_index.refresh()
+        groups = index.groups
+        self.group_parent = index.group_parent
 
         count = 0
 
@@ -469,8 +564,8 @@ class GISCloudQgisCore(object):
         """This method analyzes groups to detect which
         groups on GIS Cloud should be updated, created or deleted"""
         for layer in GISCloudQgisUtils.get_qgis_layers(self.project):
-            layer_legend = self.project.layerTreeRoot().findLayer(layer.id())
-            group = layer_legend.parent()
+            entry = self.layer_tree_index.get(layer.id())
+            group = entry["parent_node"] if entry else None
             if group:
                 layer_id = layer.id()
                 if layer_id in self.layers_to_update:
@@ -496,6 +591,29 @@ class GISCloudQgisCore(object):
                                     current_group] = \
                                     self.gc_api.giscloud_groups[group_id]
 
+    def analyze_manifest_groups(self):
+        """Folders that can't be matched through their layers are matched
+        by their group id stored in the sync manifest"""
+        manifest = self.gc_api.manifest
+        if not manifest or manifest.get("version", 1) < 2 or \
+           not manifest.get("groups"):
+            return
+        giscloud_groups = dict((str(group_id), group) for group_id, group
+                               in self.gc_api.giscloud_groups.items())
+        mapped_ids = [str(group["id"]) for group
+                      in self.gc_api.giscloud_groups_map.values()]
+        folder_ids = dict((group_id, folder_id) for folder_id, group_id
+                          in manifest["groups"].items())
+        index = self.layer_tree_index.refresh()
+        for group in index.groups:
+            if group in self.gc_api.giscloud_groups_map:
+                continue
+            folder_id = folder_ids.get(index.group_id(group))
+            if folder_id in giscloud_groups and folder_id not in mapped_ids:
+                self.gc_api.giscloud_groups_map[group] = \
+                    giscloud_groups[folder_id]
+                mapped_ids.append(folder_id)
+
     def analyze_layers(self, force=False, new_map=False, for_publish=False):
         """This method does layer analysis in QGIS by comparing QGIS state
         to the state on GIS Cloud. We are computing differences and then
@@ -523,26 +641,41 @@ class GISCloudQgisCore(object):
         if not new_map:
             current_time = (datetime.datetime.utcnow() -
                             datetime.datetime(1970, 1, 1)).total_seconds()
-            if force or current_time - self.last_analysis["time"] > 30 or \
-               self.last_analysis["map_id"] != self.gc_api.map.map_id:
+            if self.gc_api.layers_cache_provisional and not force:
+                # layer listing stored in the project gives a quick
+                # result, forced analysis revalidates it
+                LOGGER.info("provisional analysis")
+            elif force or \
+                    current_time - self.last_analysis["time"] > 30 or \
+                    self.last_analysis["map_id"] != self.gc_api.map.map_id:
                 self.last_analysis["time"] = current_time
                 self.last_analysis["map_id"] = self.gc_api.map.map_id
                 use_cache = False
 
         result["dirname"] = dirname
         if self.gc_api.map.map_id:
-            self.gc_api.get_layers(use_cache)
+            try:
+                self.gc_api.get_layers(use_cache)
+            except Exception:
+                # incomplete listing must not be used from the cache
+                self.last_analysis["time"] = 0
+                raise
         if not self.gc_api.map.map_id:
             self.layers_to_update = {}
             self.gc_api.giscloud_groups = {}
             self.gc_api.layers_to_delete = []
 
+        # superseded analysis stops between stages
+        token = get_current_token()
+        token.check()
         self.analyze_groups()
+        self.analyze_manifest_groups()
+        moved_layers = self.plan_tree_order()
         self.get_layers_to_upload(for_publish)
+        token.check()
         self.check_folders_for_updates(result)
         for layer in self.layers_to_upload:
-            group = GISCloudQgisUtils.get_qgis_layer_parent(layer.qgis_layer,
-                                                            self.project)
+            group = self.layer_tree_index.parent(layer.original_id)
             layer.datasource_timestamp = \
                 self.layer_data_timestamps[layer.original_id] \
                 if layer.original_id in self.layer_data_timestamps \
@@ -552,35 +685,12 @@ class GISCloudQgisCore(object):
                  self.layers_to_update[layer.original_id][
                      "datasource_timestamp"] != layer.datasource_timestamp)
             layer.parent = self.gc_api.qgis_groups[group] if group else None
+        token.check()
         self.check_layers_for_updates(result)
         result["layers_to_delete"] = len(self.gc_api.layers_to_delete)
 
-        list1 = []
-        for key in self.layers_to_update:
-            list1.append({"id": key,
-                          "order": self.layers_to_update[key]["order"]})
-        list1.sort(key=lambda x: x["order"])
-        list1 = [x["id"] for x in list1]
-
-        list2 = []
-        for layer in self.layers_to_upload:
-            list2.append({"id": layer.original_id, "order": layer.order})
-        list2.sort(key=lambda x: x["order"])
-        list2 = [x["id"] for x in list2]
-
-        did_order_changed = []
-        for tag, from_1, to_1, from_2, to_2 in SequenceMatcher(
-                None, list1, list2).get_opcodes():
-            if tag in ('delete', 'replace'):
-                did_order_changed.extend(list1[from_1:to_1])
-            if tag in ('insert', 'replace'):
-                did_order_changed.extend(list2[from_2:to_2])
-
-        # if there are duplicates then it means that order has been changed
-        # as item has been removed from their position and moved
-        # to another position
-        result["layers_order_changed"] = \
-            len(did_order_changed) != len(set(did_order_changed))
+        # only layers that are out of order with the rest are updated
+        result["layers_order_changed"] = bool(moved_layers)
         LOGGER.info("analyze_layers {}".format(result))
 
         self.last_analysis["result"] = result
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+
+ Aggregator for QGIS layer and layer tree signals. Layers can emit signals
+ in bursts (editing, auto-refresh), so we drop signals that don't change
+ anything we publish, collect changed layers into a dirty set and run
+ the analysis once per burst.
+
+"""
+
+import time
+
+from .logger import get_gc_publisher_logger
+from .version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import QObject, QTimer
+else:
+    from PyQt4.QtCore import QObject, QTimer
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+
+class GISCloudQgisEventAggregator(QObject):
+    """Coalesces layer events and calls back with the set of dirty layers.
+
+    Debounce delay starts at min_delay and doubles for every event that
+    arrives while the run is pending, but a run is never postponed more
+    than max_delay after the first event of a burst. Runs are at least
+    min_interval apart. All times are in milliseconds."""
+
+    # signals that only affect rendering in QGIS and not published state
+    render_only_signals = ("repaintRequested", "statusChanged")
+
+    def __init__(self, callback, min_delay=50, max_delay=1000,
+                 min_interval=500):
+        QObject.__init__(self)
+        self.callback = callback
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_interval = min_interval
+        self.delay = min_delay
+        self.dirty_layers = set()
+        self.events_count = 0
+        self.burst_start = None
+        self.last_flush = 0
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    @staticmethod
+    def is_render_only(signal_name):
+        """Check if signal can be ignored for analysis"""
+        return signal_name in \
+            GISCloudQgisEventAggregator.render_only_signals
+
+    def notify(self, layer_id=None):
+        """Register an event, layer_id None stands for layer tree change"""
+        now = time.time() * 1000
+        if self.burst_start is None:
+            self.burst_start = now
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.delay * 2, self.max_delay)
+
+        self.events_count += 1
+        self.dirty_layers.add(layer_id)
+
+        run_at = min(now + self.delay, self.burst_start + self.max_delay)
+        run_at = max(run_at, self.last_flush + self.min_interval)
+        self.timer.start(max(0, int(run_at - now)))
+
+    def flush(self):
+        """Burst has settled, run the callback with dirty layers"""
+        dirty_layers = self.dirty_layers
+        LOGGER.debug("Coalesced {} events, dirty layers {}".format(
+            self.events_count, list(dirty_layers)))
+
+        self.reset()
+        self.last_flush = time.time() * 1000
+        self.callback(dirty_layers)
+
+    def reset(self):
+        """Drop all pending events"""
+        self.timer.stop()
+        self.dirty_layers = set()
+        self.events_count = 0
+        self.burst_start = None
+        self.delay = self.min_delay
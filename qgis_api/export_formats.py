@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+
+ Registry of vector formats that layers can be converted to before upload,
+ with a small benchmark that picks the fastest format to write and upload
+ for a layer of a given size.
+
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from osgeo import gdal
+from qgis.core import QgsFeatureRequest, QgsVectorFileWriter
+
+from .logger import get_gc_publisher_logger
+from ..gis_cloud_api.network_handler import GISCloudNetworkHandler
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+EXPORT_FORMATS = {}
+BENCHMARK_CACHE = {}
+BENCHMARK_SAMPLE_SIZE = 1000
+
+
+def register_export_format(name, driver, extension, datasource_options=None,
+                           layer_options=None, hilbert_order=False,
+                           sqlite_tuning=False):
+    """Registering an OGR based export format.
+
+    hilbert_order - features are sorted along a Hilbert curve before writing
+    sqlite_tuning - file is an SQLite database, so we can set pragmas
+    and vacuum it after writing"""
+    # pylint: disable=R0913
+    EXPORT_FORMATS[name] = {"name": name,
+                            "driver": driver,
+                            "extension": extension,
+                            "datasource_options": datasource_options or [],
+                            "layer_options": layer_options or [],
+                            "hilbert_order": hilbert_order,
+                            "sqlite_tuning": sqlite_tuning}
+
+
+def get_export_format(name):
+    """Returns registered format, falling back to plain SQLite"""
+    if name in EXPORT_FORMATS and is_export_format_available(name):
+        return EXPORT_FORMATS[name]
+    return EXPORT_FORMATS["sqlite"]
+
+
+def is_export_format_available(name):
+    """Checking if GDAL has been built with format's driver"""
+    return gdal.GetDriverByName(EXPORT_FORMATS[name]["driver"]) is not None
+
+
+def choose_export_format(layer, tmp_dir):
+    """Picking the fastest format for a layer. Benchmark results are
+    cached by geometry type and order of magnitude of feature count."""
+    count = max(layer.featureCount(), 0)
+    key = (layer.wkbType(), int(math.log10(count + 1)))
+    if key not in BENCHMARK_CACHE:
+        results = benchmark_export_formats(layer, tmp_dir)
+        BENCHMARK_CACHE[key] = min(results, key=results.get)
+        LOGGER.info('Export format benchmark for {}: {}, using {}'.format(
+            layer.name(), results, BENCHMARK_CACHE[key]))
+    return EXPORT_FORMATS[BENCHMARK_CACHE[key]]
+
+
+def benchmark_export_formats(layer, tmp_dir):
+    """Estimating write and upload time in seconds for each format.
+    We write an empty file and a sample of features, so fixed costs
+    (headers, metadata tables) aren't scaled up with the feature count.
+    Upload size is estimated as deflated size since uploads are zipped."""
+    request = QgsFeatureRequest()
+    request.setLimit(BENCHMARK_SAMPLE_SIZE)
+    sample = list(layer.getFeatures(request))
+    # provider may not know the count (-1), sample is all we have then
+    count = max(layer.featureCount(), len(sample))
+    scale = float(count) / len(sample) if sample else 0
+    upload_rate = GISCloudNetworkHandler.upload_rate
+
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    # own directory, so samples don't clash with files being uploaded
+    sample_dir = tempfile.mkdtemp(prefix='benchmark_', dir=tmp_dir)
+
+    results = {}
+    try:
+        for name in EXPORT_FORMATS:
+            if not is_export_format_available(name):
+                continue
+            base_cost = _write_sample(layer, sample_dir,
+                                      EXPORT_FORMATS[name], [])
+            sample_cost = _write_sample(layer, sample_dir,
+                                        EXPORT_FORMATS[name], sample)
+            write_time = base_cost[0] + \
+                (sample_cost[0] - base_cost[0]) * scale
+            size = base_cost[1] + (sample_cost[1] - base_cost[1]) * scale
+            results[name] = write_time + size / upload_rate
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+    return results
+
+
+def _write_sample(layer, sample_dir, export_format, features):
+    """Returns write time and deflated size of features written in format"""
+    file_name = u'{}/benchmark_{}.{}'.format(sample_dir,
+                                             export_format["name"],
+                                             export_format["extension"])
+    start_time = time.time()
+    writer = QgsVectorFileWriter(file_name, 'utf-8', layer.fields(),
+                                 layer.wkbType(), layer.crs(),
+                                 export_format["driver"],
+                                 export_format["datasource_options"],
+                                 export_format["layer_options"])
+    writer.addFeatures(features)
+    del writer
+    write_time = time.time() - start_time
+
+    size = 0
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as sample_file:
+            size = len(zlib.compress(sample_file.read(), 6))
+        os.remove(file_name)
+    return write_time, size
+
+
+register_export_format("sqlite", "SQLite", "sqlite")
+register_export_format("spatialite", "SQLite", "sqlite",
+                       datasource_options=['SPATIALITE=YES'],
+                       layer_options=['SPATIAL_INDEX=YES'],
+                       hilbert_order=True,
+                       sqlite_tuning=True)
+register_export_format("gpkg", "GPKG", "gpkg",
+                       layer_options=['SPATIAL_INDEX=YES'],
+                       hilbert_order=True,
+                       sqlite_tuning=True)
+# FlatGeobuf driver sorts features and writes packed Hilbert R-tree itself
+register_export_format("fgb", "FlatGeobuf", "fgb",
+                       layer_options=['SPATIAL_INDEX=YES'])
@@ -47,4 +47,9 @@ class GISCloudQgisLayerEvent(object):
         self.gui.qgis_api.layer_data_timestamps[self.layer.id()] = \
             (datetime.datetime.utcnow() -
              datetime.datetime(1970, 1, 1)).total_seconds()
-        self.gui.handle_project_update()
+        self.gui.handle_layer_update(self.layer.id())
+
+    def handle_state_change(self, *args):
+        """Style, name, CRS and similar changes mark the layer as dirty"""
+        # pylint: disable=W0613
+        self.gui.handle_layer_update(self.layer.id())
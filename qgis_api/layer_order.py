@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Planning layer and folder orders so that moving a few items in QGIS
+ changes the order of only a few items on GIS Cloud.
+
+"""
+
+from bisect import bisect_left
+
+# gap left between orders that have to be assigned anew,
+# so the next move into the same place doesn't renumber neighbours
+ORDER_SPACING = 16
+
+
+def longest_increasing_subsequence(values):
+    """Indices of the longest strictly increasing subsequence"""
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        position = bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[position] = value
+            tail_indices[position] = index
+        previous[index] = tail_indices[position - 1] if position else None
+
+    result = []
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        result.append(index)
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def plan_orders(items, remote_orders):
+    """Items are listed bottom to top, remote_orders holds GIS Cloud order
+    of items that are already published. Items on the longest run that is
+    still in order keep their order, others get new orders between their
+    neighbours. If there is no room between neighbours, run is extended
+    upwards until there is. Items below the lowest kept item get orders
+    below it, which may go under the current minimum, so moving a layer
+    to the bottom doesn't renumber the whole map."""
+    known = [position for position, item in enumerate(items)
+             if item in remote_orders]
+    kept = [known[index] for index in longest_increasing_subsequence(
+        [remote_orders[items[position]] for position in known])]
+
+    orders = {}
+    lower = None
+    start = 0
+    anchor = 0
+    while start < len(items):
+        while anchor < len(kept) and kept[anchor] < start:
+            anchor += 1
+        if anchor < len(kept) and kept[anchor] == start:
+            lower = orders[items[start]] = remote_orders[items[start]]
+            start += 1
+            continue
+
+        while True:
+            end = kept[anchor] if anchor < len(kept) else len(items)
+            upper = remote_orders[items[end]] \
+                if anchor < len(kept) else None
+            if upper is None or lower is None or \
+                    upper - lower - 1 >= end - start:
+                break
+            anchor += 1
+
+        count = end - start
+        for index in range(count):
+            if upper is None:
+                order = (lower or 0) + ORDER_SPACING * (index + 1)
+            elif lower is None:
+                order = upper - ORDER_SPACING * (count - index)
+            else:
+                order = lower + (index + 1) * (upper - lower) // (count + 1)
+            orders[items[start + index]] = order
+        lower = orders[items[end - 1]]
+        start = end
+    return orders
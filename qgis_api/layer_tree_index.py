@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Index of the project layer tree, built with a single walk and shared
+ by project analysis instead of searching the tree for every layer.
+
+"""
+
+import threading
+import uuid
+
+from qgis.core import QgsLayerTreeGroup, QgsLayerTreeLayer
+
+from .version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import Qt
+else:
+    from PyQt4.QtCore import Qt
+
+GROUP_ID_PROPERTY = "giscloud/group_id"
+
+
+class GISCloudLayerTreeIndex(object):
+    """Layer tree index, rebuilt only after the tree structure changes.
+
+    tree_order - layers and groups mapped to their order on GIS Cloud
+    groups - groups with subgroups listed after their parent
+    group_parent - group mapped to its parent node
+    group_depth - group mapped to its depth, top level groups are 0
+
+    Index is used from the main thread and from workers, so rebuilds
+    are serialized by a lock. Every rebuild makes a new frozen index
+    that isn't changed afterwards, refresh hands it out, so its
+    attributes always belong to the same build."""
+    # pylint: disable=R0902
+
+    def __init__(self, frozen=False):
+        self.root = None
+        self.dirty = not frozen
+        self.frozen = frozen
+        self.current = None
+        self.layers = {}
+        self.tree_order = {}
+        self.groups = []
+        self.group_parent = {}
+        self.group_depth = {}
+        self.lock = threading.RLock()
+
+    def attach(self, root):
+        """Following structure changes of the project layer tree"""
+        self.detach()
+        self.root = root
+        self.root.addedChildren.connect(self.invalidate)
+        self.root.removedChildren.connect(self.invalidate)
+        self.dirty = True
+
+    def detach(self):
+        """Stop following the layer tree"""
+        if self.root is None:
+            return
+        try:
+            self.root.addedChildren.disconnect(self.invalidate)
+            self.root.removedChildren.disconnect(self.invalidate)
+        except (TypeError, RuntimeError):
+            pass
+        self.root = None
+
+    def invalidate(self, *_):
+        """Layer tree has changed, index is rebuilt on the next use"""
+        self.dirty = True
+
+    def refresh(self):
+        """Rebuilding the index if the tree has changed,
+        returns the frozen index of the last build"""
+        if self.frozen:
+            return self
+        with self.lock:
+            if self.dirty or self.current is None:
+                self.__build()
+            return self.current
+
+    def get(self, layer_id):
+        """Index entry of a layer: node, parent, parent_node, depth
+        and order. Layer nodes get their layers after they are added,
+        so unknown layer forces a rebuild. Returns None for a layer
+        that isn't in the tree, e.g. it has just been removed."""
+        if self.frozen:
+            return self.layers.get(layer_id)
+        with self.lock:
+            if layer_id not in self.refresh().layers:
+                self.__build()
+            return self.current.layers.get(layer_id)
+
+    def parent(self, layer_id):
+        """Group of a layer or None for top level layers
+        and layers that aren't in the tree"""
+        entry = self.get(layer_id)
+        return entry["parent"] if entry else None
+
+    def is_visible(self, layer_id):
+        """Is layer checked in the layer tree, layers that aren't
+        in the tree aren't visible"""
+        entry = self.get(layer_id)
+        if not entry:
+            return False
+        node = entry["node"]
+        if ISQGIS3:
+            return node.itemVisibilityChecked()
+        return node.isVisible() != Qt.Unchecked
+
+    def group_path(self, group):
+        """Path of group names from the top, e.g. Roads/Highways"""
+        names = []
+        while group in self.group_parent:
+            names.insert(0, group.name())
+            group = self.group_parent[group]
+        return "/".join(names)
+
+    @staticmethod
+    def group_id(group):
+        """Id of a group kept in the project, groups with the same name
+        and parent are told apart by it"""
+        return group.customProperty(GROUP_ID_PROPERTY) or None
+
+    def assign_group_ids(self):
+        """Giving ids to new groups and to copies of a group, it changes
+        the tree so it is called from the main thread"""
+        if self.root is None:
+            return
+        used = set()
+        nodes = list(self.root.children())
+        while nodes:
+            node = nodes.pop(0)
+            if not isinstance(node, QgsLayerTreeGroup):
+                continue
+            group_id = self.group_id(node)
+            if not group_id or group_id in used:
+                group_id = uuid.uuid4().hex
+                node.setCustomProperty(GROUP_ID_PROPERTY, group_id)
+            used.add(group_id)
+            nodes.extend(node.children())
+
+    def __build(self):
+        # cleared first so a change during the walk isn't lost
+        self.dirty = False
+        index = GISCloudLayerTreeIndex(True)
+        if self.root is not None:
+            max_order = index.__walk(self.root, 0, 0)
+            for item in index.tree_order:
+                index.tree_order[item] = \
+                    max_order - index.tree_order[item] + 1
+            for entry in index.layers.values():
+                entry["order"] = index.tree_order[entry["node"].layer()]
+            index.groups.reverse()
+        self.current = index
+        self.layers = index.layers
+        self.tree_order = index.tree_order
+        self.groups = index.groups
+        self.group_parent = index.group_parent
+        self.group_depth = index.group_depth
+
+    def __walk(self, node, order, depth):
+        for child in node.children():
+            order = order + 1
+            if child and isinstance(child, QgsLayerTreeGroup):
+                self.tree_order[child] = order
+                self.group_parent[child] = node
+                self.group_depth[child] = depth
+                order = self.__walk(child, order, depth + 1)
+                self.groups.append(child)
+
+            elif isinstance(child, QgsLayerTreeLayer) and child.layer():
+                self.tree_order[child.layer()] = order
+                self.layers[child.layer().id()] = {
+                    "node": child,
+                    "parent": node if node.name() != '' else None,
+                    "parent_node": node,
+                    "depth": depth,
+                    "order": None}
+        return order
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Snapshot of the project state taken on the main thread. Layer tree,
+ layer metadata and sources are copied into plain Python data, so the
+ analysis worker can tell if anything changed without touching QGIS
+ objects. Styles aren't captured, their changes are reported by layer
+ events.
+
+"""
+
+from .snapshot_analysis import SNAPSHOT_VERSION
+
+
+def take_snapshot(qgis_api):
+    """Capturing the project state, must be called on the main thread"""
+    if not qgis_api.project:
+        return None
+
+    index = qgis_api.layer_tree_index.refresh()
+    qgis_api.read_export_options()
+
+    layers = {}
+    for layer_id, entry in index.layers.items():
+        layer = entry["node"].layer()
+        layers[layer_id] = {
+            "name": layer.name(),
+            "provider": layer.providerType(),
+            "source": layer.source(),
+            "crs": layer.crs().authid(),
+            "visible": index.is_visible(layer_id),
+            "order": entry["order"],
+            "parent": index.group_path(entry["parent"])
+                      if entry["parent"] else None,
+            "data_timestamp": qgis_api.layer_data_timestamps.get(
+                layer_id, 0)}
+
+    groups = [[index.group_path(group), index.tree_order[group]]
+              for group in index.groups]
+
+    return {"version": SNAPSHOT_VERSION,
+            "crs": qgis_api.get_project_crs(),
+            "export_options": dict(qgis_api.export_options),
+            "layers": layers,
+            "groups": groups}
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Analysis of project snapshots. Snapshots are plain Python data, so
+ nothing here touches QGIS and it is safe to run in any thread or
+ process.
+
+"""
+
+SNAPSHOT_VERSION = 1
+
+LAYER_KEYS = ("name", "provider", "source", "crs", "visible", "order",
+              "parent", "data_timestamp")
+
+
+def compare_snapshots(previous, current):
+    """Differences between two snapshots.
+
+    layers_added, layers_removed - layer ids
+    layers_changed - layer id mapped to the list of changed keys
+    groups_changed - group paths or their order differ
+    project_changed - CRS, export options or snapshot version differ"""
+    previous = previous or {}
+    previous_layers = previous.get("layers", {})
+    current_layers = current.get("layers", {})
+
+    layers_changed = {}
+    for layer_id, layer in current_layers.items():
+        if layer_id not in previous_layers:
+            continue
+        keys = [key for key in LAYER_KEYS
+                if layer.get(key) != previous_layers[layer_id].get(key)]
+        if keys:
+            layers_changed[layer_id] = keys
+
+    return {
+        "layers_added": sorted(set(current_layers) - set(previous_layers)),
+        "layers_removed": sorted(set(previous_layers) - set(current_layers)),
+        "layers_changed": layers_changed,
+        "groups_changed": previous.get("groups") != current.get("groups"),
+        "project_changed": any(previous.get(key) != current.get(key)
+                               for key in ("version", "crs",
+                                           "export_options"))}
+
+
+def has_changes(changes):
+    """Does a comparison of snapshots hold any difference"""
+    return bool(changes["layers_added"] or
+                changes["layers_removed"] or
+                changes["layers_changed"] or
+                changes["groups_changed"] or
+                changes["project_changed"])
@@ -32,24 +32,46 @@
 
 import hashlib
 import json
+import multiprocessing
 import os
 from os.path import basename
 import re
-from urllib.parse import parse_qsl
+import sqlite3
+import time
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport, jobs run one by one
+    ThreadPoolExecutor = None
+
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    from urlparse import parse_qsl
 
 from qgis.core import QgsApplication, QgsLayerTreeNode, QgsMapLayer
 from qgis.core import QgsVectorFileWriter, QgsVectorLayer
 from qgis.utils import iface
+from osgeo import gdal
 from .version import ISQGIS3
 from .logger import get_gc_publisher_logger
+from ..gis_cloud_api.cancellation import get_current_token
+from ..gis_cloud_api.exception import GISCloudException
 
 if ISQGIS3:
+    from qgis.core import QgsCoordinateTransform, QgsFeatureRequest
+    from qgis.core import QgsFeedback
+    from qgis.core import QgsFields, QgsRenderContext, QgsUnitTypes
     from qgis.core import QgsWkbTypes
 else:
     from qgis.core import QGis
 
 LOGGER = get_gc_publisher_logger(__name__)
 
+EXPORT_BATCH_SIZE = 10000
+HILBERT_SIDE = 1 << 16
+
 
 class GISCloudQgisUtils(object):
     """Utility methods based on QGIS Api."""
@@ -58,13 +80,14 @@ class GISCloudQgisUtils(object):
     def get_layer_source_files(layer_object, gc_api):
         """Getting source and assets files that we need to upload."""
 
-        # converting symbology by exporting images (e.g. points, hatch fills)
-        for asset in layer_object.assets:
-            asset["symbol"].exportImage(asset["full_path"],
-                                        'png',
-                                        asset["size"])
+        # converting symbology by exporting images (e.g. points, hatch fills),
+        # during sync they are already rendered by render_assets
+        for asset in GISCloudQgisUtils.get_assets_to_upload(layer_object,
+                                                            gc_api):
+            if not asset.get("rendered"):
+                GISCloudQgisUtils.render_asset(asset)
+                gc_api.files_to_delete_after_upload.append(asset["full_path"])
             layer_object.files.append([asset["full_path"], asset["file"]])
-            gc_api.files_to_delete_after_upload.append(asset["full_path"])
 
         if not layer_object.source_dir:
             return
@@ -75,27 +98,15 @@ class GISCloudQgisUtils(object):
 
         if layer_object.source_to_convert:
             layer = layer_object.qgis_layer
+            extension = "." + layer_object.export_format["extension"]
             gc_file = re.sub(source_no_ext,
                              layer_object.id,
-                             layer.id() + ".sqlite",
+                             layer.id() + extension,
                              flags=re.I)
             if layer_object.should_updata_data or gc_file not in gc_api.current_gc_files:
                 gc_api.files_to_delete_after_upload.append(
-                    layer_object.source_to_convert + ".sqlite")
-                if ISQGIS3:
-                    QgsVectorFileWriter.writeAsVectorFormat(
-                        layer,
-                        layer_object.source_to_convert,
-                        'utf-8',
-                        layer.crs(),
-                        'SQLite')
-                else:
-                    QgsVectorFileWriter.writeAsVectorFormat(
-                        layer,
-                        layer_object.source_to_convert,
-                        'utf-8',
-                        None,
-                        'SQLite')
+                    layer_object.source_to_convert + extension)
+                GISCloudQgisUtils.export_vector_source(layer_object, gc_api)
         files = os.listdir(source_dir)
         for _file in files:
             filename = _file.lower().split('.')
@@ -116,6 +127,412 @@ class GISCloudQgisUtils(object):
                     layer_object.files.append(
                         [source_dir + '/' + _file, gc_file])
 
+    @staticmethod
+    def export_vector_source(layer_object, gc_api):
+        """Converting vector layer to a format that GIS Cloud can read."""
+        layer = layer_object.qgis_layer
+
+        if gc_api.qgis_api.vector_profile_enabled():
+            options = gc_api.qgis_api.export_options
+            attributes = None
+            if options["vector_used_fields_only"]:
+                attributes = GISCloudQgisUtils.get_used_fields(
+                    layer,
+                    layer_object.styles,
+                    options["vector_fields_allowlist"])
+            GISCloudQgisUtils.export_vector_profile(
+                layer,
+                layer_object.source_to_convert,
+                layer_object.export_format,
+                options,
+                gc_api.qgis_api.project,
+                attributes)
+        elif ISQGIS3:
+            # feedback lets cancelled sync stop the export
+            token = get_current_token()
+            feedback = QgsFeedback()
+            save_options = QgsVectorFileWriter.SaveVectorOptions()
+            save_options.driverName = 'SQLite'
+            save_options.fileEncoding = 'utf-8'
+            save_options.feedback = feedback
+            token.register_feedback(feedback)
+            try:
+                result = QgsVectorFileWriter.writeAsVectorFormat(
+                    layer,
+                    layer_object.source_to_convert,
+                    save_options)
+            finally:
+                token.unregister_feedback(feedback)
+            token.check()
+            GISCloudQgisUtils.check_writer_result(layer, result)
+        else:
+            GISCloudQgisUtils.check_writer_result(
+                layer,
+                QgsVectorFileWriter.writeAsVectorFormat(
+                    layer,
+                    layer_object.source_to_convert,
+                    'utf-8',
+                    None,
+                    'SQLite'))
+
+    @staticmethod
+    def check_writer_result(layer, result):
+        """Raising GISCloudException if vector export has failed,
+        result is an error code or (error code, message)"""
+        error, message = result[:2] \
+            if isinstance(result, tuple) else (result, "")
+        if error != QgsVectorFileWriter.NoError:
+            raise GISCloudException(
+                "Export of layer {} has failed: {}".format(
+                    layer.name(), message))
+
+    @staticmethod
+    def get_export_crs(layer, project, options):
+        """CRS vector layer is exported in. Layer is reprojected to the
+        project CRS only if it has an EPSG code that GIS Cloud can be
+        told about, otherwise layer keeps its own CRS."""
+        if options["vector_reproject"] and \
+                project.crs().isValid() and \
+                project.crs().authid().startswith("EPSG:"):
+            return project.crs()
+        return layer.crs()
+
+    @staticmethod
+    def export_vector_profile(layer, file_name, export_format, options,
+                              project, attributes=None):
+        """Writing features in export_format reprojected to the map CRS,
+        simplified for the target scale and snapped to the precision grid.
+        If attributes (field indices) are given, only those fields are read
+        and written. Returns geometry size report in WKB bytes."""
+        # pylint: disable=R0913,R0914
+        file_name = file_name + "." + export_format["extension"]
+        dest_crs = GISCloudQgisUtils.get_export_crs(layer, project, options)
+        transform = None
+        if dest_crs != layer.crs():
+            transform = QgsCoordinateTransform(layer.crs(), dest_crs, project)
+
+        # one pixel at 90 dpi is 0.28 mm on paper
+        tolerance = options["vector_simplify_scale"] * 0.00028
+        if tolerance and dest_crs.mapUnits() == QgsUnitTypes.DistanceDegrees:
+            tolerance = tolerance / 111320.0
+        precision = options["vector_precision"]
+
+        request = QgsFeatureRequest()
+        fields = layer.fields()
+        if attributes is not None:
+            request.setSubsetOfAttributes(attributes)
+            fields = QgsFields()
+            for index in attributes:
+                fields.append(layer.fields().at(index))
+            LOGGER.info('Exporting {} of {} fields of {}'.format(
+                len(attributes), layer.fields().count(), layer.name()))
+
+        features = layer.getFeatures(request)
+        step_time = time.time()
+        if export_format["hilbert_order"]:
+            features = GISCloudQgisUtils.get_features_in_order(
+                layer, request,
+                GISCloudQgisUtils.get_hilbert_order(layer, request))
+            LOGGER.info('Hilbert ordering of {} took {:.2f} s'.format(
+                layer.name(), time.time() - step_time))
+            step_time = time.time()
+        # page size only takes effect before the first table is created,
+        # journal and sync are not needed for a temp file. Option is set
+        # only for this thread, other SQLite files keep their journal.
+        pragma = gdal.GetThreadLocalConfigOption('OGR_SQLITE_PRAGMA', None)
+        if export_format["sqlite_tuning"]:
+            gdal.SetThreadLocalConfigOption(
+                'OGR_SQLITE_PRAGMA',
+                'page_size={},journal_mode=OFF,synchronous=OFF'.format(
+                    options["vector_page_size"]))
+        try:
+            writer = QgsVectorFileWriter(file_name, 'utf-8', fields,
+                                         layer.wkbType(), dest_crs,
+                                         export_format["driver"],
+                                         export_format["datasource_options"],
+                                         export_format["layer_options"])
+            if writer.hasError() != QgsVectorFileWriter.NoError:
+                raise GISCloudException(
+                    "Export of layer {} has failed: {}".format(
+                        layer.name(), writer.errorMessage()))
+            report = {"features": 0, "bytes_before": 0, "bytes_after": 0}
+            token = get_current_token()
+            batch = []
+            for feature in features:
+                if attributes is not None:
+                    values = feature.attributes()
+                    feature.setFields(fields)
+                    feature.setAttributes([values[i] for i in attributes])
+                geometry = feature.geometry()
+                if geometry and not geometry.isEmpty():
+                    report["bytes_before"] += len(geometry.asWkb())
+                    if transform:
+                        geometry.transform(transform)
+                    if tolerance:
+                        simplified = geometry.simplify(tolerance)
+                        if simplified and not simplified.isEmpty():
+                            geometry = simplified
+                    if precision:
+                        geometry = geometry.snappedToGrid(precision,
+                                                          precision)
+                    report["bytes_after"] += len(geometry.asWkb())
+                    feature.setGeometry(geometry)
+                batch.append(feature)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    GISCloudQgisUtils.write_features(layer, writer, batch)
+                    batch = []
+                    token.check()
+                report["features"] += 1
+            if batch:
+                GISCloudQgisUtils.write_features(layer, writer, batch)
+            # spatial index is built when the writer is closed
+            del writer
+        finally:
+            gdal.SetThreadLocalConfigOption('OGR_SQLITE_PRAGMA', pragma)
+        LOGGER.info('Writing {} as {} took {:.2f} s'.format(
+            layer.name(), export_format["name"], time.time() - step_time))
+
+        if export_format["sqlite_tuning"]:
+            step_time = time.time()
+            connection = sqlite3.connect(file_name)
+            connection.execute('VACUUM')
+            connection.close()
+            LOGGER.info('Vacuum of {} took {:.2f} s'.format(
+                layer.name(), time.time() - step_time))
+
+        if report["bytes_before"]:
+            report["reduction"] = \
+                100.0 - 100.0 * report["bytes_after"] / report["bytes_before"]
+            LOGGER.info('Export of {}: {} features, geometry {} -> {} bytes '
+                        '({:.1f}% smaller)'.format(layer.name(),
+                                                   report["features"],
+                                                   report["bytes_before"],
+                                                   report["bytes_after"],
+                                                   report["reduction"]))
+        return report
+
+    @staticmethod
+    def write_features(layer, writer, features):
+        """Adding features to the export, raising GISCloudException
+        if the writer refuses them"""
+        if not writer.addFeatures(features):
+            raise GISCloudException(
+                "Export of layer {} has failed: {}".format(
+                    layer.name(), writer.errorMessage()))
+
+    @staticmethod
+    def get_hilbert_order(layer, request):
+        """Returns feature ids sorted along a Hilbert curve over the layer
+        extent, so features that are close in space are close in the file."""
+        extent = layer.extent()
+        width = extent.width() or 1.0
+        height = extent.height() or 1.0
+        max_cell = HILBERT_SIDE - 1
+
+        keys_request = QgsFeatureRequest(request)
+        keys_request.setSubsetOfAttributes([])
+        keys = []
+        for feature in layer.getFeatures(keys_request):
+            geometry = feature.geometry()
+            key = 0
+            if geometry and not geometry.isEmpty():
+                center = geometry.boundingBox().center()
+                x = int((center.x() - extent.xMinimum()) / width * max_cell)
+                y = int((center.y() - extent.yMinimum()) / height * max_cell)
+                key = hilbert_index(HILBERT_SIDE,
+                                    min(max(x, 0), max_cell),
+                                    min(max(y, 0), max_cell))
+            keys.append((key, feature.id()))
+        keys.sort()
+        return [fid for _, fid in keys]
+
+    @staticmethod
+    def get_features_in_order(layer, request, ordered_fids):
+        """Yields features in a given order, fetching them in chunks"""
+        for start in range(0, len(ordered_fids), EXPORT_BATCH_SIZE):
+            fids = ordered_fids[start:start + EXPORT_BATCH_SIZE]
+            chunk_request = QgsFeatureRequest(request)
+            chunk_request.setFilterFids(fids)
+            chunk = {}
+            for feature in layer.getFeatures(chunk_request):
+                chunk[feature.id()] = feature
+            for fid in fids:
+                if fid in chunk:
+                    yield chunk[fid]
+
+    @staticmethod
+    def get_used_fields(layer, styles, allowlist=""):
+        """Returns indices of fields referenced by renderer, translated
+        styles (labels and rule expressions), map tips, subset string
+        and comma separated allowlist."""
+        names = set(name.strip().lower() for name in allowlist.split(',')
+                    if name.strip())
+        if layer.renderer():
+            names.update(name.lower() for name in
+                         layer.renderer().usedAttributes(QgsRenderContext()))
+
+        texts = [layer.mapTipTemplate(),
+                 layer.displayExpression(),
+                 layer.subsetString()]
+        for style in styles:
+            for key in ("labelfield", "textfield"):
+                if style.get(key):
+                    names.add(style[key].lower())
+                    texts.append(style[key])
+            texts.append(style.get("expression", ""))
+        text = " ".join(texts).lower()
+
+        attributes = []
+        for index, field in enumerate(layer.fields()):
+            name = field.name().lower()
+            if name in names or \
+               re.search(r'(^|\W){}(\W|$)'.format(re.escape(name)), text):
+                attributes.append(index)
+        return attributes
+
+    @staticmethod
+    def get_assets_to_upload(layer_object, gc_api):
+        """Assets that are not on GIS Cloud yet. Asset file names are
+        hashes of symbol properties, so a symbol used by several styles
+        is listed once."""
+        assets = {}
+        for asset in layer_object.assets:
+            if asset["file"] not in assets and \
+               (layer_object.should_updata_data or
+                    asset["file"] not in gc_api.current_gc_files):
+                assets[asset["file"]] = asset
+        return list(assets.values())
+
+    @staticmethod
+    def render_asset(asset, token=None):
+        """Exporting asset symbol to PNG, every export uses its own
+        image and render context"""
+        if token:
+            token.check()
+        asset["symbol"].exportImage(asset["full_path"], 'png', asset["size"])
+        asset["rendered"] = True
+
+    @staticmethod
+    def render_assets(layer_objects, gc_api):
+        """Rendering assets of all layers in a thread pool before the
+        upload starts, render time is logged per layer."""
+        layer_assets = [
+            (layer_object,
+             GISCloudQgisUtils.get_assets_to_upload(layer_object, gc_api))
+            for layer_object in layer_objects]
+        layer_assets = [(layer_object, assets)
+                        for layer_object, assets in layer_assets if assets]
+        if not layer_assets:
+            return
+
+        # images are removed even if the sync stops before their upload
+        for _, assets in layer_assets:
+            gc_api.files_to_delete_after_upload.extend(
+                asset["full_path"] for asset in assets)
+
+        start_time = time.time()
+        # pool threads have no token of their own
+        token = get_current_token()
+        max_workers = min(sum(len(assets) for _, assets in layer_assets),
+                          get_cpu_count())
+
+        def render_layer_asset(asset):
+            asset_start_time = time.time()
+            GISCloudQgisUtils.render_asset(asset, token)
+            return time.time() - asset_start_time
+
+        with get_executor(max_workers) as executor:
+            jobs = [(layer_object,
+                     [executor.submit(render_layer_asset, asset)
+                      for asset in assets])
+                    for layer_object, assets in layer_assets]
+            for layer_object, layer_jobs in jobs:
+                try:
+                    render_time = sum(job.result() for job in layer_jobs)
+                except Exception:
+                    token.check()
+                    LOGGER.error('Failed to render symbols of {}'.format(
+                        layer_object.name), exc_info=True)
+                    raise
+                LOGGER.info('Rendered {} symbols of {} in {:.1f} ms'.format(
+                    len(layer_jobs), layer_object.name, render_time * 1000))
+        LOGGER.info('Rendered symbols of {} layers in {:.1f} s'.format(
+            len(layer_assets), time.time() - start_time))
+
+    @staticmethod
+    def build_optimized_rasters(layer_objects, gc_api):
+        """Converting rasters that are going to be uploaded in a thread pool,
+        GDAL releases GIL so conversions run in parallel."""
+        layers_to_convert = [
+            layer_object for layer_object in layer_objects
+            if layer_object.raster_to_convert and
+            (layer_object.should_updata_data or
+             basename(layer_object.source["src"])
+             not in gc_api.current_gc_files)]
+        if not layers_to_convert:
+            return
+
+        start_time = time.time()
+        # pool threads have no token of their own
+        token = get_current_token()
+        max_workers = min(len(layers_to_convert), get_cpu_count())
+        with get_executor(max_workers) as executor:
+            jobs = [(layer_object,
+                     executor.submit(GISCloudQgisUtils.build_optimized_raster,
+                                     layer_object.raster_to_convert,
+                                     layer_object.converted_raster,
+                                     token))
+                    for layer_object in layers_to_convert]
+            for layer_object, job in jobs:
+                gc_api.files_to_delete_after_upload.append(
+                    layer_object.converted_raster)
+                try:
+                    job.result()
+                except Exception:
+                    token.check()
+                    LOGGER.error('Failed to convert raster {}'.format(
+                        layer_object.raster_to_convert), exc_info=True)
+                    raise
+        LOGGER.info('Converted {} rasters in {:.1f} s'.format(
+            len(layers_to_convert), time.time() - start_time))
+
+    @staticmethod
+    def build_optimized_raster(source, destination, token=None):
+        """Writing a tiled GeoTIFF in web mercator with internal overviews.
+        COG driver (GDAL >= 3.1) does it in one pass, otherwise we warp to
+        a tiled GeoTIFF and build overviews ourselves.
+        GDAL stops as soon as the token is cancelled."""
+
+        def progress(*_):
+            return 0 if token and token.cancelled else 1
+
+        if gdal.GetDriverByName('COG'):
+            options = gdal.TranslateOptions(
+                format='COG',
+                creationOptions=['TILING_SCHEME=GoogleMapsCompatible',
+                                 'COMPRESS=DEFLATE',
+                                 'OVERVIEWS=IGNORE_EXISTING',
+                                 'BIGTIFF=IF_SAFER',
+                                 'NUM_THREADS=ALL_CPUS'],
+                callback=progress)
+            dataset = gdal.Translate(destination, source, options=options)
+        else:
+            options = gdal.WarpOptions(
+                format='GTiff',
+                dstSRS='EPSG:3857',
+                creationOptions=['TILED=YES',
+                                 'COMPRESS=DEFLATE',
+                                 'BIGTIFF=IF_SAFER'],
+                callback=progress)
+            dataset = gdal.Warp(destination, source, options=options)
+            if dataset:
+                dataset.BuildOverviews('AVERAGE', [2, 4, 8, 16, 32, 64],
+                                       callback=progress)
+
+        if not dataset:
+            raise Exception(gdal.GetLastErrorMsg())
+        dataset = None
+
     @staticmethod
     def find_layer_source(layer, layer_object, source, tmp_dir_len):
         """Pasing layer source and sanitizing file name."""
@@ -245,17 +662,6 @@ class GISCloudQgisUtils(object):
                     project.layerTreeRoot().findLayers()]
         return iface.legendInterface().layers()
 
-    @staticmethod
-    def get_qgis_layer_parent(layer, project):
-        """Define parent and child relationship for layers.
-
-        When there exists tree structure in project (folders and layers),
-        parent and child relationship between folders and layers must
-        be defined correctly in order to show them same as in qgis."""
-        root = project.layerTreeRoot()
-        group = root.findLayer(layer.id()).parent()
-        return group if group.name() != '' else None
-
     @staticmethod
     def copy_to_cliboard(content):
         """Copy content to clipboard"""
@@ -273,3 +679,71 @@ class GISCloudQgisUtils(object):
     def is_layer_tree_node(tree_node):
         """checking if tree node is layer type """
         return tree_node.nodeType() == QgsLayerTreeNode.NodeLayer
+
+
+def hilbert_index(side, x, y):
+    """Distance of a cell along the Hilbert curve filling side x side grid,
+    side has to be a power of two."""
+    index = 0
+    step = side // 2
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        index += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        step //= 2
+    return index
+
+
+def get_cpu_count():
+    """Number of CPUs, 1 if it can't be determined"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def get_executor(max_workers):
+    """Thread pool, or serial executor where thread pools
+    aren't available (Python 2)"""
+    if ThreadPoolExecutor is None:
+        return GISCloudSerialExecutor()
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+class GISCloudSerialExecutor(object):
+    """Executor that runs every job as soon as it is submitted"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    @staticmethod
+    def submit(function, *args):
+        """Running the job, its result or exception is kept for later"""
+        return GISCloudSerialJob(function, *args)
+
+
+class GISCloudSerialJob(object):
+    """Finished job of the serial executor"""
+    # pylint: disable=R0903
+
+    def __init__(self, function, *args):
+        self.value = None
+        self.exception = None
+        try:
+            self.value = function(*args)
+        except Exception as exception:
+            self.exception = exception
+
+    def result(self):
+        """Result of the job, exception of the job is raised again"""
+        if self.exception is not None:
+            raise self.exception
+        return self.value
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Tests of the upload throttle.
+
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import pytest
+
+pytest.importorskip("qgis.core")
+
+# plugin is a package, it is imported by its directory name
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(PLUGIN_DIR))
+PLUGIN = os.path.basename(PLUGIN_DIR)
+throttle = importlib.import_module(PLUGIN + ".gis_cloud_api.throttle")
+version = importlib.import_module(PLUGIN + ".qgis_api.version")
+
+if version.ISQGIS3:
+    from PyQt5.QtCore import QIODevice  # pylint: disable=E0611
+else:
+    from PyQt4.QtCore import QIODevice  # pylint: disable=E0611
+
+READ_MODE = QIODevice.ReadOnly | QIODevice.Unbuffered
+
+
+class GISCloudThrottledFileTest(unittest.TestCase):
+    """Reading an upload body through the throttled device"""
+
+    def setUp(self):
+        handle, self.file_name = tempfile.mkstemp()
+        self.data = os.urandom(64 * 1024)
+        with os.fdopen(handle, 'wb') as body:
+            body.write(self.data)
+        self.throttle = throttle.GISCloudUploadThrottle()
+        self.throttle.configure({"upload_rate_limit": 128,
+                                 "upload_schedule": "",
+                                 "upload_adaptive": False})
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_throttled_read(self):
+        """Whole body is read as bytes, no faster than the limit"""
+        device = throttle.GISCloudThrottledFile(self.file_name, self.throttle)
+        self.assertTrue(device.open(READ_MODE))
+        start_time = time.time()
+        chunks = []
+        while not device.atEnd():
+            chunk = device.read(16 * 1024)
+            self.assertIsInstance(chunk, bytes)
+            chunks.append(chunk)
+        elapsed = time.time() - start_time
+        device.close()
+
+        self.assertEqual(b''.join(chunks), self.data)
+        # bucket starts empty, so 64 KB at 128 KB/s takes half a second
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_single_read_wait_is_short(self):
+        """A read doesn't block for the whole bucket deficit"""
+        device = throttle.GISCloudThrottledFile(self.file_name, self.throttle)
+        self.assertTrue(device.open(READ_MODE))
+        start_time = time.time()
+        chunk = device.read(16 * 1024)
+        self.assertLess(time.time() - start_time, 0.1)
+        self.assertTrue(0 < len(chunk) < 16 * 1024)
+        device.close()
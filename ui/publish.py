@@ -37,6 +37,7 @@ from ..qgis_api.logger import get_gc_publisher_logger
 from ..qgis_api.version import ISQGIS3
 from ..workers.map_check import GISCloudWorkerMapCheck
 from ..workers.sync import GISCloudWorkerSync
+from ..workers.sync_clean_up import GISCloudWorkerSyncCleanUp
 
 if ISQGIS3:
     from PyQt5 import QtGui, uic
@@ -103,6 +104,10 @@ class GISCloudUiPublish(QObject):
         self.sync_task.taskFinished.connect(self.publish_done)
         self.sync_task.somethingFailed.connect(self.publish_failed)
         self.sync_task.noMapToUpdate.connect(self.manager.deleted_map_message)
+        self.sync_clean_up_task = GISCloudWorkerSyncCleanUp(self.api)
+        self.sync_task.cleanUpNeeded.connect(self.sync_clean_up_task.clean_up)
+        self.sync_clean_up_task.finished.connect(self.start_pending_sync)
+        self.sync_pending = False
 
         self.message_box = QMessageBox()
 
@@ -209,6 +214,11 @@ class GISCloudUiPublish(QObject):
             'giscloud_layers_data_state',
             'state',
             json.dumps(self.qgis_api.layer_data_timestamps))
+        self.qgis_api.project.writeEntry(
+            'giscloud_layers_export_format',
+            'state',
+            json.dumps(self.qgis_api.export_format_choices))
+        self.api.store_failed_deletions()
 
         map_name = self.qgis_api.get_map_name(True)
         self.qgis_api.project.writeEntry(
@@ -266,6 +276,7 @@ class GISCloudUiPublish(QObject):
 
     def publish_failed(self, layer, error_details):
         """Handle failed publish and restore previous state."""
+        self.api.store_failed_deletions()
         self.publish_restore_prev_map_state()
         self.manager.inform_fail(layer, error_details)
 
@@ -275,5 +286,17 @@ class GISCloudUiPublish(QObject):
         self.publish_details_dock.map_name.setFocus()
 
     def start_sync_task(self):
-        """Starting the sync"""
+        """Starting the sync, after clean up of a cancelled sync"""
+        if self.sync_clean_up_task.isRunning() or \
+                self.sync_clean_up_task.is_pending():
+            self.sync_pending = True
+            return
+        # folders are stored in the manifest by group id
+        self.qgis_api.layer_tree_index.assign_group_ids()
         self.sync_task.start()
+
+    def start_pending_sync(self):
+        """Starting the sync that waited for the clean up"""
+        if self.sync_pending:
+            self.sync_pending = False
+            self.start_sync_task()
@@ -174,8 +174,8 @@ class GISCloudUiUpdate(QObject):
         msg_prefix11 = "All layers set to \"visible\" " + \
                        "will be updated in GIS Cloud, reflecting " + \
                        "the changes made in QGIS."
-        msg_prefix2 = "All previously published layers will be updated " + \
-                      "because you changed layer ordering."
+        msg_prefix2 = "Layers and folders you moved will be updated " + \
+                      "to reflect the new layer ordering."
         msg_removed = " Previously uploaded layers, removed from QGIS, " + \
                       "will also be removed from GIS Cloud."
         msg_n_layers = " Any not previously published layers " + \
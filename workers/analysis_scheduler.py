@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Scheduler of map analysis runs. Every request gets a new generation,
+ a running analysis is cancelled when a newer request arrives and only
+ results of the latest generation are passed on.
+
+"""
+
+from .map_analysis import GISCloudWorkerMapAnalysis
+from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.project_snapshot import take_snapshot
+from ..qgis_api.version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import pyqtSignal, QObject
+else:
+    from PyQt4.QtCore import pyqtSignal, QObject
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+
+class GISCloudAnalysisScheduler(QObject):
+    """Runs one analysis at a time. Requests made during a run are
+    coalesced into a single run that starts when the current one ends,
+    so the latest project state is always analysed exactly once.
+    Dirty layers are collected until a result of the latest
+    generation arrives, superseded runs don't lose them."""
+    result = pyqtSignal(dict)
+
+    def __init__(self, qgis_api):
+        QObject.__init__(self)
+        self.qgis_api = qgis_api
+        self.generation = 0
+        self.pending = False
+        self.dirty_layers = set()
+        self.worker = GISCloudWorkerMapAnalysis(qgis_api)
+        self.worker.result.connect(self.__handle_result)
+        self.worker.finished.connect(self.__handle_finished)
+
+    def request(self, dirty_layers):
+        """Project has changed, analysis of the new state is needed.
+        Dirty layers are ids of changed layers, None stands for
+        a layer tree change."""
+        self.generation += 1
+        self.dirty_layers |= dirty_layers
+        if self.worker.isRunning():
+            LOGGER.debug("Superseding analysis {}".format(
+                self.worker.generation))
+            self.pending = True
+            self.worker.cancel()
+            return
+        self.__start()
+
+    def stop(self):
+        """Cancelling the running analysis and dropping pending one"""
+        self.pending = False
+        self.dirty_layers = set()
+        self.generation += 1
+        self.worker.cancel()
+        self.worker.wait()
+
+    def __start(self):
+        self.pending = False
+        # snapshot only tells the worker if the run can be skipped,
+        # analysis itself still reads the project in the worker
+        self.worker.start_generation(self.generation,
+                                     take_snapshot(self.qgis_api),
+                                     set(self.dirty_layers))
+
+    def __handle_result(self, generation, result):
+        if generation != self.generation:
+            LOGGER.debug("Dropping result of stale analysis {}".format(
+                generation))
+            return
+        self.dirty_layers = set()
+        self.result.emit(result)
+
+    def __handle_finished(self):
+        # finished of an earlier run can be delivered after a new start
+        if self.pending and not self.worker.isRunning():
+            self.__start()
@@ -30,7 +30,14 @@
 
 """
 
+import time
+
+from ..gis_cloud_api.cancellation import GISCloudCancellationToken
+from ..gis_cloud_api.cancellation import set_current_token
+from ..gis_cloud_api.exception import GISCloudCancelled
+from ..gis_cloud_api.network_handler import GISCloudNetworkHandler
 from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.snapshot_analysis import compare_snapshots, has_changes
 from ..qgis_api.version import ISQGIS3
 
 if ISQGIS3:
@@ -42,22 +49,80 @@ LOGGER = get_gc_publisher_logger(__name__)
 
 
 class GISCloudWorkerMapAnalysis(QThread):
-    """Handling map analysis to decide if update is needed"""
+    """Handling map analysis to decide if update is needed.
+    Result is emitted together with the generation of the run."""
     # pylint: disable=R0903
-    result = pyqtSignal(dict)
+    result = pyqtSignal(int, dict)
 
     def __init__(self, qgis_api):
         self.qgis_api = qgis_api
+        self.snapshot = None
+        self.dirty_layers = set()
+        self.analyzed_snapshot = None
+        self.generation = 0
+        self.token = GISCloudCancellationToken()
         QThread.__init__(self)
 
     def __del(self):
         self.wait()
 
+    def start_generation(self, generation, snapshot, dirty_layers):
+        """Starting analysis of a snapshot, called on the main thread"""
+        self.generation = generation
+        self.snapshot = snapshot
+        self.dirty_layers = dirty_layers
+        self.token = GISCloudCancellationToken()
+        self.start()
+
+    def cancel(self):
+        """Stopping the run, it has been superseded"""
+        self.token.cancel()
+
     def run(self):
-        """Running map analysis and returning back the result."""
+        """Running map analysis and returning back the result.
+        Snapshot is used only to skip a run, analyze_layers reads
+        the project layers and layer tree itself."""
+        generation = self.generation
+        snapshot = self.snapshot
+        dirty_layers = self.dirty_layers
+        set_current_token(self.token)
         try:
+            if self.is_unchanged(snapshot, dirty_layers):
+                LOGGER.debug("Project is unchanged since the last analysis")
+                self.result.emit(generation,
+                                 self.qgis_api.last_analysis["result"])
+                return
+            if self.qgis_api.gc_api.map.map_id:
+                GISCloudNetworkHandler.warm_up(self.qgis_api.gc_api.host)
             result_analysis = self.qgis_api.analyze_layers()
-            self.result.emit(result_analysis)
+            if self.qgis_api.gc_api.layers_cache_provisional:
+                self.result.emit(generation, result_analysis)
+                LOGGER.debug("Revalidating stored GIS Cloud layers")
+                result_analysis = self.qgis_api.analyze_layers(True)
+            self.analyzed_snapshot = snapshot
+            self.result.emit(generation, result_analysis)
+        except GISCloudCancelled:
+            # GIS Cloud layers may be only partially read
+            self.qgis_api.last_analysis["time"] = 0
+            LOGGER.debug("Analysis {} has been superseded".format(
+                generation))
         except Exception:
             LOGGER.critical('MapAnalysis has failed with exception: ',
                             exc_info=True)
+        finally:
+            set_current_token(None)
+
+    def is_unchanged(self, snapshot, dirty_layers):
+        """Is the project same as in the last analysis. Layers that
+        reported a change are always analysed again, results are reused
+        only for layer tree events while GIS Cloud layers would come from
+        the cache, sync and publish reset it."""
+        last_analysis = self.qgis_api.last_analysis
+        if dirty_layers - set([None]) or \
+           not snapshot or not self.analyzed_snapshot or \
+           not last_analysis["time"] or "result" not in last_analysis or \
+           time.time() - last_analysis["time"] > 30 or \
+           last_analysis.get("map_id") != self.qgis_api.gc_api.map.map_id:
+            return False
+        return not has_changes(
+            compare_snapshots(self.analyzed_snapshot, snapshot))
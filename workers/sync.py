@@ -30,8 +30,14 @@
 
 """
 import os
+import time
+from ..gis_cloud_api.cancellation import GISCloudCancellationToken
+from ..gis_cloud_api.cancellation import set_current_token
+from ..gis_cloud_api.exception import GISCloudCancelled
+from ..gis_cloud_api.network_handler import GISCloudNetworkHandler
 from ..qgis_api.version import ISQGIS3
 from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.utils import GISCloudQgisUtils
 
 if ISQGIS3:
     from PyQt5.QtCore import QThread, pyqtSignal
@@ -40,6 +46,9 @@ else:
 
 LOGGER = get_gc_publisher_logger(__name__)
 
+# seconds between storing layer states during the sync
+STATE_SAVE_INTERVAL = 30
+
 
 class GISCloudWorkerSync(QThread):
     """Syncs layers from QGIS to GIS Cloud."""
@@ -48,6 +57,8 @@ class GISCloudWorkerSync(QThread):
     notifyProgress = pyqtSignal(int, int)
     somethingFailed = pyqtSignal(object, str)
     noMapToUpdate = pyqtSignal()
+    # layer states should be stored, unfinished layer id or None
+    cleanUpNeeded = pyqtSignal(bool, object)
     notifyUploadProgress = pyqtSignal(int, int, int)
 
     def __init__(self, api, qgis_api):
@@ -56,6 +67,10 @@ class GISCloudWorkerSync(QThread):
         self.layer_index = 0
         self.total_layers = 0
         self.abort = False
+        self.cancellation_token = GISCloudCancellationToken()
+        self.unfinished_layer_id = None
+        self.manifest_started = False
+        self.state_save_time = 0
         QThread.__init__(self)
 
     def upload_progress(self, bytes_sent, bytes_total):
@@ -72,8 +87,17 @@ class GISCloudWorkerSync(QThread):
         """Start the sync."""
         last_layer = None
         self.abort = False
+        self.cancellation_token = GISCloudCancellationToken()
+        self.unfinished_layer_id = None
+        self.manifest_started = False
+        set_current_token(self.cancellation_token)
         LOGGER.info('syncTask started')
         try:
+            # TLS handshake runs while we are analysing the project
+            GISCloudNetworkHandler.warm_up(self.api.host)
+            GISCloudNetworkHandler.upload_throttle.configure(
+                self.qgis_api.upload_options)
+
             # whole upload process is contained here
             if not os.path.exists(self.qgis_api.tmp_dir):
                 os.makedirs(self.qgis_api.tmp_dir)
@@ -99,12 +123,19 @@ class GISCloudWorkerSync(QThread):
             self.api.get_current_gc_files()
             self.api.datasources_cache = {}
 
+            GISCloudQgisUtils.build_optimized_rasters(layers, self.api)
+            GISCloudQgisUtils.render_assets(layers, self.api)
+
             self.total_layers = len(layers)
             self.layer_index = 1
 
             LOGGER.info('Numbers of layers to upload: {}'.format(
                 self.total_layers))
 
+            self.api.start_manifest()
+            self.manifest_started = True
+            self.state_save_time = time.time()
+
             for layer in layers:
                 if self.abort:
                     break
@@ -122,15 +153,36 @@ class GISCloudWorkerSync(QThread):
                                                100)
 
                 layer.create_layer()
+                self.unfinished_layer_id = layer.created_layer_id
                 layer.create_option()
+                self.unfinished_layer_id = None
                 self.layer_index += 1
+                # states are stored as we go, so a crash doesn't lose them
+                if time.time() - self.state_save_time > STATE_SAVE_INTERVAL:
+                    self.__save_sync_state(False)
 
+            self.__save_sync_state()
             self.api.clean_up_tmp_files()
+            LOGGER.info('TLS handshakes (count, seconds) {}'.format(
+                GISCloudNetworkHandler.handshake_latency))
+            LOGGER.info('Request latency (count, seconds) {}'.format(
+                GISCloudNetworkHandler.request_latency))
+            LOGGER.info('Transferred bytes (wire, uncompressed) {}'.format(
+                GISCloudNetworkHandler.transfer_bytes))
             if not self.abort:
                 self.qgis_api.last_analysis["time"] = 0
                 self.msleep(500)
                 self.taskFinished.emit()
+        except GISCloudCancelled:
+            LOGGER.info('SyncTask has been cancelled')
+            self.api.clean_up_tmp_files()
+            self.qgis_api.last_analysis["time"] = 0
+            self.__hand_over_clean_up()
         except Exception as exception:
+            try:
+                self.__save_sync_state()
+            except GISCloudCancelled:
+                self.__hand_over_clean_up()
             self.api.clean_up_tmp_files()
             self.qgis_api.last_analysis["time"] = 0
             LOGGER.critical('SyncTask has failed with exception: ',
@@ -142,8 +194,32 @@ class GISCloudWorkerSync(QThread):
                 self.somethingFailed.emit(last_layer, msg)
         self.quit()
 
+    def __save_sync_state(self, final=True):
+        """Storing state of layers that were synced so far in the manifest,
+        layers missing from it wouldn't be matched on the next sync"""
+        if not self.manifest_started:
+            return
+        try:
+            self.api.save_layer_states()
+        except GISCloudCancelled:
+            raise
+        except Exception:
+            LOGGER.error('Failed to store sync manifest', exc_info=True)
+        self.state_save_time = time.time()
+        if final:
+            self.manifest_started = False
+
+    def __hand_over_clean_up(self):
+        """Cancelled sync is cleaned up by another task, requests
+        made here would block the main thread waiting in quit"""
+        self.cleanUpNeeded.emit(self.manifest_started,
+                                self.unfinished_layer_id)
+        self.manifest_started = False
+        self.unfinished_layer_id = None
+
     def quit(self):
         """graceful exit when quiting the task"""
         self.abort = True
+        self.cancellation_token.cancel()
         QThread.quit(self)
         QThread.wait(self)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+                                 A QGIS plugin
+ GIS Cloud Publisher
+                              -------------------
+        copyright            : (C) 2019 by GIS Cloud Ltd.
+        email                : info@giscloud.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *  This program is distributed in the hope that it will be useful,        *
+ *  but WITHOUT ANY WARRANTY; without even the implied warranty of         *
+ *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          *
+ *  GNU General Public License for more details.                           *
+ *                                                                         *
+ *  This program is free software; you can redistribute it and/or modify   *
+ *  it under the terms of the GNU General Public License as published by   *
+ *  the Free Software Foundation; either version 2 of the License, or      *
+ *  (at your option) any later version.                                    *
+ *                                                                         *
+ *  You should have received a copy of the GNU General Public License      *
+ *  along with this program.  If not, see <https://www.gnu.org/licenses/>. *
+ *                                                                         *
+ ***************************************************************************/
+
+ Worker that finishes up a cancelled sync, it stores states of layers
+ that were synced and deletes layers that were left without their state.
+
+"""
+
+import threading
+
+from ..gis_cloud_api.cancellation import set_current_token
+from ..qgis_api.logger import get_gc_publisher_logger
+from ..qgis_api.version import ISQGIS3
+
+if ISQGIS3:
+    from PyQt5.QtCore import QThread
+else:
+    from PyQt4.QtCore import QThread
+
+LOGGER = get_gc_publisher_logger(__name__)
+
+
+class GISCloudWorkerSyncCleanUp(QThread):
+    """Thread that cleans up after a cancelled sync, so the main thread
+    doesn't wait for these requests. Clean up requested while it runs
+    is done in another run once it finishes."""
+
+    def __init__(self, api):
+        self.api = api
+        self.save_states = False
+        self.unfinished_layer_ids = []
+        self.lock = threading.Lock()
+        QThread.__init__(self)
+        self.finished.connect(self.__start_pending)
+
+    def clean_up(self, save_states, unfinished_layer_id):
+        """Starting the clean up of a cancelled sync"""
+        with self.lock:
+            self.save_states = self.save_states or save_states
+            if unfinished_layer_id:
+                self.unfinished_layer_ids.append(unfinished_layer_id)
+        if not self.isRunning():
+            self.start()
+
+    def is_pending(self):
+        """Clean up has been requested and not started yet"""
+        with self.lock:
+            return self.save_states or bool(self.unfinished_layer_ids)
+
+    def __start_pending(self):
+        if self.is_pending() and not self.isRunning():
+            self.start()
+
+    def run(self):
+        """Storing layer states and deleting unfinished layers"""
+        # cancelled sync token must not stop these requests
+        set_current_token(None)
+        with self.lock:
+            save_states = self.save_states
+            unfinished_layer_ids = self.unfinished_layer_ids
+            self.save_states = False
+            self.unfinished_layer_ids = []
+        if save_states:
+            try:
+                self.api.save_layer_states()
+            except Exception:
+                LOGGER.error('Failed to store sync manifest', exc_info=True)
+        # layer without stored state would never be matched again
+        if unfinished_layer_ids:
+            try:
+                self.api.delete_resources(unfinished_layer_ids)
+            except Exception:
+                LOGGER.error('Failed to delete unfinished layers',
+                             exc_info=True)